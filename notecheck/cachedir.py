@@ -0,0 +1,253 @@
+"""Maintenance of the cache dir of rendered svgs
+
+The cache dir holds a directory per generation (renderer and its version, see
+Renderer.generation) of svgs with their precompressed variants. It is kept
+under CACHE_MAX_BYTES by evicting the least recently used svgs, and the
+generations of the old renderer versions are garbage collected. Hit and miss
+counters of each process are flushed into STATS_DIR."""
+import json, os, shutil, threading, time
+
+from django.conf import settings
+
+from . import lilypond
+
+# Size budget of the cache dir. Least recently used entries are evicted when
+# it is exceeded.
+CACHE_MAX_BYTES = getattr(settings, 'NOTECHECK_CACHE_MAX_BYTES', 512*1024*1024)
+
+# Per-process hit and miss counters are flushed to the cache dir this often
+# (in seconds), so the rendercache command can report them. Counters of the
+# processes which haven't flushed them for STATS_MAX_AGE seconds, e.g. the
+# ones restarted meanwhile, are removed by gc.
+STATS_FLUSH_INTERVAL = 60
+STATS_MAX_AGE = 24*3600
+STATS_DIR = '.stats'
+
+# Number of the most recently written generations of each renderer kept by gc
+# besides the current ones, e.g. the generation of the hosts which weren't
+# upgraded yet.
+CACHE_KEEP_GENERATIONS = getattr(settings, 'NOTECHECK_CACHE_KEEP_GENERATIONS', 2)
+
+_stats_lock = threading.Lock()
+_counters = {'disk_hits': 0, 'disk_misses': 0}
+_stats_flushed = time.monotonic()
+_stats_filename = '{}-{}.json'.format(os.getpid(), int(time.time()))
+_unpruned_bytes = 0
+
+def touch(filename: str):
+    """marks cache entry as recently used for eviction, regardless of the atime mount options"""
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+
+def count(**counts):
+    """increases the counters and periodically flushes counters of this process to the cache dir"""
+    global _stats_flushed
+
+    with _stats_lock:
+        for counter, n in counts.items():
+            _counters[counter] += n
+        now = time.monotonic()
+        if now - _stats_flushed < STATS_FLUSH_INTERVAL:
+            return
+        _stats_flushed = now
+    flush_stats()
+
+def add_written(written: int):
+    """evicts old entries once in a while, when enough new ones were written"""
+    global _unpruned_bytes
+
+    with _stats_lock:
+        _unpruned_bytes += written
+        should_prune = _unpruned_bytes > CACHE_MAX_BYTES // 20
+        if should_prune:
+            _unpruned_bytes = 0
+    if should_prune:
+        prune()
+
+def flush_stats():
+    """writes the hit and miss counters of this process into the cache dir"""
+    stats = dict(_counters, memory_hits=lilypond.memory_cache.hits, memory_misses=lilypond.memory_cache.misses)
+    try:
+        os.makedirs(os.path.join(lilypond.CACHE_DIR, STATS_DIR), exist_ok=True)
+        lilypond._atomic_write(os.path.join(lilypond.CACHE_DIR, STATS_DIR, _stats_filename), json.dumps(stats).encode('utf-8'))
+    except OSError:
+        pass
+
+def _entries(dirname: str) -> [(float, int, str)]:
+    """returns (atime, size in bytes including compressed variants, filename) of cache entries in the directory"""
+    sizes = {}
+    atimes = {}
+    with os.scandir(dirname) as it:
+        for e in it:
+            if not e.is_file():
+                continue
+            base, ext = os.path.splitext(e.path)
+            if ext == '.svg':
+                atimes[e.path] = e.stat().st_atime
+                sizes[e.path] = sizes.get(e.path, 0) + e.stat().st_size
+            elif ext in ['.gz', '.br'] and base.endswith('.svg'):
+                sizes[base] = sizes.get(base, 0) + e.stat().st_size
+    return [(atimes[f], sizes[f], f) for f in atimes]
+
+def _remove_entry(filename: str):
+    # Plain svg first, so the entry disappears at once for readers.
+    for extension in ['', '.gz', '.br']:
+        try:
+            os.unlink(filename + extension)
+        except FileNotFoundError:
+            pass
+
+def _remove_stale(path: str, max_age: float = 3600) -> bool:
+    """removes the file or directory, e.g. a leftover of a crashed render, if it is older than max_age seconds"""
+    try:
+        if time.time() - os.stat(path).st_mtime < max_age:
+            return False
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    return True
+
+def current_generations() -> [str]:
+    return [r.generation() for r in lilypond.RENDERERS.values()]
+
+def _generations() -> [str]:
+    """returns names of the generation directories in the cache dir"""
+    return [name for name in os.listdir(lilypond.CACHE_DIR)
+            if not name.startswith('.') and os.path.isdir(os.path.join(lilypond.CACHE_DIR, name))]
+
+def kept_generations() -> {str}:
+    """returns the generations not to be garbage collected
+
+    Besides the current ones, these are the CACHE_KEEP_GENERATIONS most recently
+    written generations of each renderer, since the cache dir can be shared by
+    hosts with different renderer versions, and all generations of the renderers
+    which are not available in this process, e.g. lilypond missing from the PATH
+    of a cron job, whose current generation is unknown."""
+    kept = set(current_generations())
+    generations = sorted(_generations(), key=lambda name: os.path.getmtime(os.path.join(lilypond.CACHE_DIR, name)), reverse=True)
+    for renderer in lilypond.RENDERERS.values():
+        own = [name for name in generations if name.startswith(renderer.name + '-')]
+        kept.update(own if not renderer.available() else own[:CACHE_KEEP_GENERATIONS])
+    return kept
+
+def gc() -> (int, int):
+    """removes cache entries of the renderer versions other than the kept ones,
+    leftovers of crashed renders and counters of the processes gone for
+    STATS_MAX_AGE. Returns the number of removed entries and bytes."""
+    if not os.path.exists(lilypond.CACHE_DIR):
+        return 0, 0
+
+    kept = kept_generations()
+    removed_entries = removed_bytes = 0
+    for name in os.listdir(lilypond.CACHE_DIR):
+        path = os.path.join(lilypond.CACHE_DIR, name)
+        if name == STATS_DIR:
+            for stats_name in os.listdir(path):
+                _remove_stale(os.path.join(path, stats_name), STATS_MAX_AGE)
+        elif name == lilypond.SLOTS_DIR:
+            continue
+        elif name.startswith('.render-') or name.startswith('.tmp-') or name.endswith('.lock'):
+            _remove_stale(path)
+        elif name in kept:
+            for tmp_name in os.listdir(path):
+                if tmp_name.startswith('.tmp-') or tmp_name.endswith('.lock'):
+                    _remove_stale(os.path.join(path, tmp_name))
+        elif os.path.isdir(path):
+            entries = _entries(path)
+            removed_entries += len(entries)
+            removed_bytes += sum(size for _, size, _ in entries)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            # Entries from before the versioned cache layout.
+            if name.endswith('.svg'):
+                removed_entries += 1
+            removed_bytes += os.path.getsize(path)
+            os.unlink(path)
+
+    return removed_entries, removed_bytes
+
+def prune(max_bytes: int = None) -> (int, int):
+    """garbage collects the old generations and evicts the least recently used
+    entries until the cache dir fits into max_bytes (CACHE_MAX_BYTES by default).
+    Returns the number of removed entries and bytes."""
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    removed_entries, removed_bytes = gc()
+    if not os.path.exists(lilypond.CACHE_DIR):
+        return removed_entries, removed_bytes
+
+    entries = []
+    for generation in _generations():
+        entries += _entries(os.path.join(lilypond.CACHE_DIR, generation))
+
+    total = sum(size for _, size, _ in entries)
+    for atime, size, filename in sorted(entries):
+        if total <= max_bytes:
+            break
+        _remove_entry(filename)
+        total -= size
+        removed_entries += 1
+        removed_bytes += size
+
+    return removed_entries, removed_bytes
+
+def clear():
+    """removes all cache entries and statistics"""
+    if os.path.exists(lilypond.CACHE_DIR):
+        for name in os.listdir(lilypond.CACHE_DIR):
+            path = os.path.join(lilypond.CACHE_DIR, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+    lilypond.memory_cache.clear()
+
+def cache_stats() -> {}:
+    """returns number of entries and bytes per generation and the hit counters of
+    the processes which flushed them within STATS_MAX_AGE"""
+    current = current_generations()
+    stats = {
+        'generations': [],
+        'entries': 0,
+        'bytes': 0,
+        'max_bytes': CACHE_MAX_BYTES,
+        'memory_hits': 0,
+        'memory_misses': 0,
+        'disk_hits': 0,
+        'disk_misses': 0,
+    }
+    if not os.path.exists(lilypond.CACHE_DIR):
+        return stats
+
+    for name in sorted(os.listdir(lilypond.CACHE_DIR)):
+        path = os.path.join(lilypond.CACHE_DIR, name)
+        if name == STATS_DIR:
+            for stats_name in os.listdir(path):
+                stats_filename = os.path.join(path, stats_name)
+                try:
+                    if time.time() - os.stat(stats_filename).st_mtime >= STATS_MAX_AGE:
+                        continue
+                    with open(stats_filename, 'r') as file:
+                        counters = json.load(file)
+                except (OSError, ValueError):
+                    continue
+                for counter in ['memory_hits', 'memory_misses', 'disk_hits', 'disk_misses']:
+                    stats[counter] += counters.get(counter, 0)
+        elif os.path.isdir(path) and not name.startswith('.'):
+            entries = _entries(path)
+            stats['generations'].append({
+                'name': name,
+                'current': name in current,
+                'entries': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+            })
+            stats['entries'] += len(entries)
+            stats['bytes'] += stats['generations'][-1]['bytes']
+
+    return stats
@@ -0,0 +1,83 @@
+"""Lookup tables of the interval arithmetic and a batch api over numpy arrays
+
+Pitches are diatonic steps with 0 being C of the sub-contra octave and
+accidentals are semitones, see DiatonicPitch and Interval in models. Intervals
+are indexed by their relative quantity: 0 for prime and octave, 1 for second
+etc. up to 6 for seventh."""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Semitones of the natural notes above C by pitch % 7.
+NATURAL_SEMITONES = (0, 2, 4, 5, 7, 9, 11)
+
+# Semitones of the major or perfect interval by relative quantity.
+BASE_SEMITONES = (0, 2, 4, 5, 7, 9, 11)
+
+# Prime, fourth and fifth are perfect, diminished or augmented, but never major or minor.
+PERFECT_QUANTITY = (True, False, False, True, True, False, False)
+
+# Semitones by which the interval between natural notes differs from the major
+# or perfect one, by pitch % 7 of the lower note and relative quantity, e.g. -1
+# for the minor second e-f and 1 for the augmented fourth f-b.
+DEGREE_OFFSET = tuple(
+    tuple((NATURAL_SEMITONES[(p+q) % 7] - NATURAL_SEMITONES[p]) % 12 - BASE_SEMITONES[q] for q in range(7))
+    for p in range(7)
+)
+
+def quality(offset: int, q: int) -> int:
+    """returns the quality of the interval which is offset semitones away from the major or perfect one"""
+    if PERFECT_QUANTITY[q]:
+        return offset + (offset > 0) - (offset < 0)
+    return offset + (offset >= 0)
+
+def quality_semitones(quality: int, q: int) -> int:
+    """returns semitones by which the interval of the given quality differs from the major or perfect one
+
+    Follows Interval.semitones(): minor is one semitone below the base and
+    diminished of all but the fourth and the fifth is quality semitones below."""
+    if quality <= -2:
+        return quality + (q == 3 or q == 4)
+    if quality == -1:
+        return -1
+    if quality >= 2:
+        return quality - 1
+    return 0
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError('the batch interval api requires numpy, install notecheck[numpy]')
+
+def intervals(pitches1, accs1, pitches2, accs2, absolute: bool = True) -> ('numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray'):
+    """returns arrays of quantities, qualities and semitones of the intervals between pairs of pitches
+
+    Element-wise equivalent to Interval.from_diatonic_pitches((p1, p2), absolute)
+    and Interval.semitones() for p1 = (pitches1[i], accs1[i]) and p2 = (pitches2[i], accs2[i])."""
+    require_numpy()
+    pitches1, accs1, pitches2, accs2 = (numpy.asarray(a, dtype=numpy.int64) for a in (pitches1, accs1, pitches2, accs2))
+
+    swap = (pitches1 > pitches2) | ((pitches1 == pitches2) & (accs1 > accs2))
+    low_pitches = numpy.where(swap, pitches2, pitches1)
+    high_pitches = numpy.where(swap, pitches1, pitches2)
+    accs_diff = numpy.where(swap, accs1 - accs2, accs2 - accs1)
+
+    quantities = high_pitches - low_pitches + 1
+    q = (quantities - 1) % 7
+    offsets = numpy.asarray(DEGREE_OFFSET)[low_pitches % 7, q] + accs_diff
+    qualities = numpy.where(
+        numpy.asarray(PERFECT_QUANTITY)[q],
+        offsets + numpy.sign(offsets),
+        offsets + (offsets >= 0),
+    )
+
+    adjustments = numpy.select(
+        [qualities <= -2, qualities == -1, qualities >= 2],
+        [qualities + ((q == 3) | (q == 4)), -1, qualities - 1],
+        0,
+    )
+    semitones = numpy.abs(numpy.asarray(BASE_SEMITONES)[q] + adjustments + 12*((quantities - 1) // 7))
+
+    if not absolute:
+        quantities = numpy.where(swap, -quantities, quantities)
+    return quantities, qualities, semitones
@@ -1,15 +1,24 @@
-import hashlib, os, subprocess
+import asyncio, fcntl, gzip, hashlib, logging, os, shutil, signal, subprocess, tempfile, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from . import cachedir, lilyworker, staff
+from .svgopt import minify
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
 
 CACHE_DIR = "/tmp/notecheck/"
-LILYPOND_CMD = "lilypond -dbackend=svg -o {filename} -dno-point-and-click -dpreview -"
-
-def generate_svg(snippet: str) -> []:
-    """returns svg preview of the given lilypond snippet
-    If the svg doesn't exist yet in the cache dir, it generates it by running
-    lilypond command; otherwise it reads it from the disk."""
-    lilysrc = """\paper{
-  indent=0\mm
-  line-width=140\mm
+LILYPOND_CMD = "lilypond -dbackend=svg -o {dirname} -dno-point-and-click -dpreview -"
+LILYPOND_HEADER = """\\paper{
+  indent=0\\mm
+  line-width=140\\mm
   oddFooterMarkup=##f
   oddHeaderMarkup=##f
   bookTitleMarkup = ##f
@@ -18,24 +27,732 @@ def generate_svg(snippet: str) -> []:
 
 #(set-global-staff-size 17)	
 """
-    lilysrc += snippet
 
-    if not os.path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
+# Rendering backend, see RENDERERS.
+RENDERER = getattr(settings, 'NOTECHECK_RENDERER', 'lilypond')
+
+# Maximum number of lilypond processes run concurrently by a worker process.
+# Cache misses of a page are split into at most this many batches.
+RENDER_WORKERS = getattr(settings, 'NOTECHECK_RENDER_WORKERS', min(4, os.cpu_count() or 1))
+
+# Render on long-lived lilypond processes instead of starting lilypond for
+# every batch, see lilyworker.
+LILYPOND_WORKERS = getattr(settings, 'NOTECHECK_LILYPOND_WORKERS', True)
+
+# Maximum number of concurrent lilypond renders on the host, shared by all
+# worker processes. Renders beyond it wait in a queue for at most
+# RENDER_QUEUE_TIMEOUT seconds.
+MAX_LILYPOND_PROCESSES = getattr(settings, 'NOTECHECK_MAX_LILYPOND_PROCESSES', os.cpu_count() or 1)
+RENDER_QUEUE_TIMEOUT = getattr(settings, 'NOTECHECK_RENDER_QUEUE_TIMEOUT', 30)
+SLOTS_DIR = '.slots'
+
+# Seconds after which a lilypond process is killed.
+RENDER_TIMEOUT = getattr(settings, 'NOTECHECK_RENDER_TIMEOUT', 30)
+
+# Seconds to wait for the snippets rendered by other requests: their wait for a
+# slot and a render on a worker retried in a new process.
+RENDER_WAIT_TIMEOUT = getattr(settings, 'NOTECHECK_RENDER_WAIT_TIMEOUT', RENDER_QUEUE_TIMEOUT + 2*RENDER_TIMEOUT)
+
+# Bounds of the in-process svg cache. Each worker process holds its own copy.
+MEMORY_CACHE_MAX_ENTRIES = getattr(settings, 'NOTECHECK_MEMORY_CACHE_MAX_ENTRIES', 2000)
+MEMORY_CACHE_MAX_BYTES = getattr(settings, 'NOTECHECK_MEMORY_CACHE_MAX_BYTES', 32*1024*1024)
+
+class MemoryCache:
+    """In-process LRU cache of rendered svgs bounded by entry count and total size.
+
+    It sits in front of the disk cache so hot snippets are returned without
+    touching the file system. The hits, misses and evictions counters are
+    kept for sizing the cache per worker."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0 # total length of cached svgs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        """returns whether the key is cached without marking it as used"""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key) -> str:
+        """returns cached svg and marks it as most recently used or None, if missing"""
+        with self._lock:
+            svg = self._entries.get(key)
+            if svg is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return svg
+
+    def put(self, key, svg: str):
+        """stores svg and evicts least recently used entries until the bounds are met"""
+        if len(svg) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = svg
+            self.size += len(svg)
+
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+memory_cache = MemoryCache(MEMORY_CACHE_MAX_ENTRIES, MEMORY_CACHE_MAX_BYTES)
+
+# Shared by all requests of the process, so its size caps the total number of
+# running lilypond processes regardless of the number of concurrent requests.
+render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='lilypond')
+
+class Snippet:
+    """A staff with a clef and whole notes, the picture of a single question
+
+    skip is the number of empty whole note columns after the first note, e.g.
+    to leave space for the inner notes of a scale."""
+
+    def __init__(self, clef: str, pitches: ['DiatonicPitch'], skip: int = 0):
+        self.clef = clef.lower()
+        self.pitches = pitches
+        self.skip = skip
+        self.lilysrc = self.to_lilypond()
+
+    def __repr__(self):
+        return self.lilysrc
+
+    def to_lilypond(self) -> str:
+        lilysrc = "{{ \\omit Score.TimeSignature \\clef {clefname} {pitch}1".format(
+            clefname=self.clef,
+            pitch=self.pitches[0].to_lilypond()
+        )
+        if len(self.pitches) > 1:
+            lilysrc += " \\omit Score.BarLine" + " s1"*self.skip
+            for p in self.pitches[1:]:
+                lilysrc += " {}1".format(p.to_lilypond())
+        return lilysrc + " }"
+
+def note_snippet(clef: str, pitch: 'DiatonicPitch') -> Snippet:
+    """returns snippet of a single note"""
+    return Snippet(clef, [pitch])
+
+def interval_snippet(clef: str, pitch1: 'DiatonicPitch', pitch2: 'DiatonicPitch') -> Snippet:
+    """returns snippet of two consecutive notes"""
+    return Snippet(clef, [pitch1, pitch2])
+
+def scale_snippet(clef: str, pitch1: 'DiatonicPitch', pitch2: 'DiatonicPitch') -> Snippet:
+    """returns snippet of the first and the last note of a scale with the space for the others in between"""
+    return Snippet(clef, [pitch1, pitch2], skip=14)
+
+class Renderer:
+    """Rendering backend which writes svgs of snippets into the cache dir
+
+    Svgs are stored in a subdirectory of the cache dir (generation) specific
+    to the renderer's version, so upgrading the renderer doesn't serve stale
+    svgs and the old generations can be garbage collected."""
+    name: str
+
+    def version(self) -> str:
+        """returns string identifying everything which affects the rendered output"""
+        raise NotImplementedError
+
+    def available(self) -> bool:
+        """returns whether the renderer can run in this process and its version is known"""
+        return True
+
+    def generation(self) -> str:
+        """returns name of the cache subdirectory of the current renderer version"""
+        return "{}-{}".format(self.name, hashlib.md5(self.version().encode('utf-8')).hexdigest()[:8])
+
+    def cache_key(self, snippet: Snippet) -> str:
+        """returns the path of the snippet's svg relative to the cache dir"""
+        raise NotImplementedError
+
+    def render(self, jobs: {}):
+        """renders the filename->snippet dict of jobs"""
+        raise NotImplementedError
+
+    async def render_async(self, jobs: {}):
+        """renders the filename->snippet dict of jobs without blocking the event loop"""
+        self.render(jobs)
+
+class LilypondRenderer(Renderer):
+    """High-fidelity backend running the lilypond binary"""
+    name = 'lilypond'
+    _version: str = None
+
+    def version(self) -> str:
+        if self._version is None:
+            try:
+                out = subprocess.run(['lilypond', '--version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+                lilypond_version = out.decode('utf-8', 'replace').split('\n')[0]
+            except FileNotFoundError:
+                lilypond_version = 'missing'
+            self._version = lilypond_version + LILYPOND_HEADER
+        return self._version
+
+    def available(self) -> bool:
+        return not self.version().startswith('missing')
+
+    def cache_key(self, snippet: Snippet) -> str:
+        lilysrc = LILYPOND_HEADER + snippet.lilysrc
+        return self.generation() + '/' + hashlib.md5(lilysrc.encode('utf-8')).hexdigest()
+
+    def render(self, jobs: {}):
+        _render_parallel({filename: snippet.lilysrc for filename, snippet in jobs.items()})
+
+    async def render_async(self, jobs: {}):
+        await _render_parallel_async({filename: snippet.lilysrc for filename, snippet in jobs.items()})
+
+class NativeRenderer(Renderer):
+    """Backend drawing snippets directly in python, see staff.py. It takes
+    microseconds per snippet, so no worker pool is involved."""
+    name = 'native'
+
+    def version(self) -> str:
+        return str(staff.VERSION)
+
+    def cache_key(self, snippet: Snippet) -> str:
+        return self.generation() + '/' + hashlib.md5(snippet.lilysrc.encode('utf-8')).hexdigest()
+
+    def render(self, jobs: {}):
+        for filename, snippet in jobs.items():
+            with open(filename, 'w') as file:
+                file.write(staff.render_svg(snippet.clef, snippet.pitches, snippet.skip))
+
+RENDERERS = {
+    'lilypond': LilypondRenderer(),
+    'native': NativeRenderer(),
+}
+
+def get_renderer(name: str = None) -> Renderer:
+    """returns the renderer of the given name or the configured one"""
+    return RENDERERS[name or RENDERER]
+
+def _cache_filename(snippet: Snippet, renderer: Renderer) -> str:
+    """returns the cache dir filename of the svg preview of the given snippet"""
+    return os.path.join(CACHE_DIR, renderer.cache_key(snippet)) + '.preview.svg'
+
+class RenderError(Exception):
+    """Rendering failed, timed out or had to wait too long for a free lilypond slot"""
+
+    def __init__(self, message: str, returncode: int = None, output: str = ''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        s = super().__str__()
+        if self.returncode is not None:
+            s += ' (exit code {})'.format(self.returncode)
+        if self.output:
+            s += ':\n' + self.output
+        return s
+
+def _delays(deadline: float, message: str):
+    """yields exponentially growing polling delays, the last one ending at the
+    deadline, and raises RenderError with the message once it passed
+
+    Callers poll before taking each delay, so they poll once more at the deadline."""
+    delay = 0.01
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RenderError(message)
+        yield min(delay, remaining)
+        delay = min(2*delay, 0.5)
+
+class _render_slot:
+    """host-wide semaphore limiting concurrent lilypond renders to MAX_LILYPOND_PROCESSES
+
+    Slots are lock files in the cache dir, so they are shared among all worker
+    processes and released by the kernel if a process dies. Waiting renders poll
+    the slots until one is free or RENDER_QUEUE_TIMEOUT expires."""
+
+    def _acquire(self) -> bool:
+        dirname = os.path.join(CACHE_DIR, SLOTS_DIR)
+        os.makedirs(dirname, exist_ok=True)
+        for i in range(MAX_LILYPOND_PROCESSES):
+            fd = os.open(os.path.join(dirname, '{}.lock'.format(i)), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.fd = fd
+                return True
+            except BlockingIOError:
+                os.close(fd)
+        return False
+
+    def _delays(self):
+        """yields the polling delays until the queue timeout"""
+        return _delays(time.monotonic() + RENDER_QUEUE_TIMEOUT,
+                       'all {} lilypond slots busy for {}s'.format(MAX_LILYPOND_PROCESSES, RENDER_QUEUE_TIMEOUT))
 
-    filename = os.path.join(CACHE_DIR, hashlib.md5(lilysrc.encode('utf-8')).hexdigest()) + '.preview.svg'
-    if os.path.exists(filename):
-        with open(filename, 'r') as file:
-            return file.read()
+    def __enter__(self):
+        delays = self._delays()
+        while not self._acquire():
+            time.sleep(next(delays))
+        return self
 
-    s = subprocess.Popen(LILYPOND_CMD.format(
-        filename=filename[:-12]).split(' '), # trim ".preview.svg" extension
+    async def __aenter__(self):
+        delays = self._delays()
+        while not self._acquire():
+            await asyncio.sleep(next(delays))
+        return self
+
+    def __exit__(self, *args):
+        os.close(self.fd)
+
+    async def __aexit__(self, *args):
+        os.close(self.fd)
+
+def _batch_source(jobs: {}) -> (str, str):
+    """returns the output directory and the lilypond source of the filename->lilypond source dict of jobs
+
+    Each snippet is wrapped in its own book named after its filename, so
+    lilypond writes a separate svg preview for every snippet. All filenames
+    need to be in the same directory."""
+    lilysrc = LILYPOND_HEADER
+    for filename, snippet in jobs.items():
+        lilysrc += "\\book {{\n  \\bookOutputName \"{name}\"\n  {snippet}\n}}\n".format(
+            name=os.path.basename(filename)[:-12], # trim ".preview.svg" extension
+            snippet=snippet
+        )
+    return os.path.dirname(next(iter(jobs))), lilysrc
+
+def _check_outputs(jobs: {}, output: str):
+    missing = [filename for filename in jobs if not os.path.exists(filename)]
+    if missing:
+        raise RenderError('lilypond did not produce {}'.format(', '.join(os.path.basename(f) for f in missing)), output=output)
+
+def _render(jobs: {}):
+    """renders the filename->lilypond source dict of jobs in a single lilypond process
+
+    The batch is rendered by a long-lived worker, if available, otherwise by a
+    new lilypond process."""
+    dirname, lilysrc = _batch_source(jobs)
+
+    with _render_slot():
+        output = None
+        if LILYPOND_WORKERS and lilyworker.pool.available:
+            fd, ly_filename = tempfile.mkstemp(dir=dirname, prefix='.batch-', suffix='.ly')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    file.write(lilysrc)
+                output = lilyworker.pool.render(ly_filename).decode('utf-8', 'replace')
+            except lilyworker.WorkerTimeout as e:
+                # Don't retry, the snippet would most likely time out again.
+                logger.error('%s', e)
+                raise RenderError(str(e))
+            except (lilyworker.WorkerError, OSError) as e:
+                # Retry the batch on a fresh process below.
+                logger.warning('lilypond worker failed, retrying in a new process: %s', e)
+            finally:
+                os.unlink(ly_filename)
+
+        if output is None:
+            output = _render_process(dirname, lilysrc)
+
+    _check_outputs(jobs, output)
+
+async def _render_async(jobs: {}):
+    """renders the filename->lilypond source dict of jobs in a single lilypond process
+    without blocking the event loop
+
+    The long-lived workers talk over blocking pipes, so they are driven from the
+    render pool threads. Otherwise the batch is rendered by a new lilypond
+    process awaited on the event loop."""
+    if LILYPOND_WORKERS and lilyworker.pool.available:
+        await asyncio.wrap_future(render_pool.submit(_render, jobs))
+        return
+
+    dirname, lilysrc = _batch_source(jobs)
+    async with _render_slot():
+        output = await _render_process_async(dirname, lilysrc)
+    _check_outputs(jobs, output)
+
+def _render_process(dirname: str, lilysrc: str) -> str:
+    """renders lilypond source into the directory by a new lilypond process and returns its output
+
+    The process runs in its own session, so it is killed together with its
+    children when it exceeds RENDER_TIMEOUT."""
+    s = subprocess.Popen(LILYPOND_CMD.format(dirname=dirname).split(' '),
         stderr=subprocess.STDOUT,
         stdout=subprocess.PIPE,
         stdin=subprocess.PIPE,
-        close_fds=True
+        close_fds=True,
+        start_new_session=True,
     )
-    out = s.communicate(lilysrc.encode('utf-8'))[0]
+    try:
+        out = s.communicate(lilysrc.encode('utf-8'), timeout=RENDER_TIMEOUT)[0]
+    except subprocess.TimeoutExpired:
+        os.killpg(s.pid, signal.SIGKILL)
+        out = s.communicate()[0]
+        logger.error('lilypond timed out after %ss', RENDER_TIMEOUT)
+        raise RenderError('lilypond timed out after {}s'.format(RENDER_TIMEOUT), s.returncode, out.decode('utf-8', 'replace'))
+
+    output = out.decode('utf-8', 'replace')
+    if s.returncode != 0:
+        logger.error('lilypond failed with exit code %s:\n%s', s.returncode, output)
+        raise RenderError('lilypond failed', s.returncode, output)
+    return output
+
+async def _render_process_async(dirname: str, lilysrc: str) -> str:
+    """asynchronous variant of _render_process"""
+    cmd = LILYPOND_CMD.format(dirname=dirname).split(' ')
+    s = await asyncio.create_subprocess_exec(*cmd,
+        stderr=asyncio.subprocess.STDOUT,
+        stdout=asyncio.subprocess.PIPE,
+        stdin=asyncio.subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        out = (await asyncio.wait_for(s.communicate(lilysrc.encode('utf-8')), RENDER_TIMEOUT))[0]
+    except asyncio.TimeoutError:
+        os.killpg(s.pid, signal.SIGKILL)
+        await s.wait()
+        logger.error('lilypond timed out after %ss', RENDER_TIMEOUT)
+        raise RenderError('lilypond timed out after {}s'.format(RENDER_TIMEOUT), s.returncode)
+
+    output = out.decode('utf-8', 'replace')
+    if s.returncode != 0:
+        logger.error('lilypond failed with exit code %s:\n%s', s.returncode, output)
+        raise RenderError('lilypond failed', s.returncode, output)
+    return output
+
+def _batches(jobs: {}) -> [{}]:
+    """splits the jobs into at most RENDER_WORKERS batches"""
+    items = list(jobs.items())
+    num_batches = min(RENDER_WORKERS, len(items))
+    return [dict(items[i::num_batches]) for i in range(num_batches)]
+
+def _render_parallel(jobs: {}):
+    """splits the filename->lilypond source dict of jobs into batches and renders
+    them concurrently on the shared render pool"""
+    futures = [render_pool.submit(_render, batch) for batch in _batches(jobs)]
+    for f in futures:
+        f.result()
+
+async def _render_parallel_async(jobs: {}):
+    """splits the filename->lilypond source dict of jobs into batches and renders
+    them concurrently on the event loop"""
+    await asyncio.gather(*[_render_async(batch) for batch in _batches(jobs)])
+
+# Process umask, read once at import as reading it means setting it.
+_umask = os.umask(0)
+os.umask(_umask)
+
+def _atomic_write(filename: str, data: bytes):
+    """writes data to a temporary file next to filename and renames it, so
+    readers never see a partially written file
+
+    The file gets the usual permissions instead of the 0600 of temporary
+    files, so the reverse proxy can serve it from the cache dir."""
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.tmp-')
+    try:
+        os.fchmod(fd, 0o644 & ~_umask)
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+
+def _publish(tmp_filename: str, filename: str) -> int:
+    """minifies freshly rendered svg and moves it into the cache dir together with
+    its gzip and brotli compressed variants
+
+    The plain svg marks the cache entry as complete, so it is moved last.
+    Returns the number of bytes written."""
+    with open(tmp_filename, 'r') as file:
+        data = minify(file.read()).encode('utf-8')
+
+    variants = [(filename + '.gz', gzip.compress(data, 9))]
+    if brotli:
+        variants.append((filename + '.br', brotli.compress(data)))
+    variants.append((filename, data))
+
+    for variant_filename, variant_data in variants:
+        _atomic_write(variant_filename, variant_data)
+    return sum(len(d) for _, d in variants)
+
+def _publish_rendered(tmp_filenames: {}) -> int:
+    """publishes the filename->temporary filename dict of rendered svgs, returns the number of bytes written"""
+    return sum(_publish(tmp_filename, filename) for filename, tmp_filename in tmp_filenames.items())
+
+def _render_into_cache(jobs: {}, renderer: Renderer):
+    """renders the filename->snippet dict of jobs into a private temporary directory
+    and atomically moves the results into the cache dir"""
+    tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR, prefix='.render-')
+    try:
+        tmp_filenames = {filename: os.path.join(tmp_dir, os.path.basename(filename)) for filename in jobs}
+        renderer.render({tmp_filenames[filename]: snippet for filename, snippet in jobs.items()})
+        written = _publish_rendered(tmp_filenames)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    cachedir.add_written(written)
+
+async def _render_into_cache_async(jobs: {}, renderer: Renderer):
+    """asynchronous variant of _render_into_cache
+
+    Compressing and writing the results and the pruning it may trigger run in
+    a thread, so they don't block the event loop."""
+    tmp_dir = tempfile.mkdtemp(dir=CACHE_DIR, prefix='.render-')
+    try:
+        tmp_filenames = {filename: os.path.join(tmp_dir, os.path.basename(filename)) for filename in jobs}
+        await renderer.render_async({tmp_filenames[filename]: snippet for filename, snippet in jobs.items()})
+        written = await asyncio.to_thread(_publish_rendered, tmp_filenames)
+    finally:
+        await asyncio.to_thread(shutil.rmtree, tmp_dir, ignore_errors=True)
+    await asyncio.to_thread(cachedir.add_written, written)
+
+def _lock(filename: str, blocking: bool) -> int:
+    """takes the per-entry render lock of the cache filename shared among all worker
+    processes. Returns the lock's file descriptor or None, if it is held by another
+    renderer and blocking is False."""
+    fd = os.open(filename + '.lock', os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+def _wait_message(filename: str) -> str:
+    return 'waited {}s for the render of {}'.format(RENDER_WAIT_TIMEOUT, os.path.basename(filename))
+
+def _wait_lock(filename: str, deadline: float) -> int:
+    """takes the render lock of the cache filename, polling until the deadline"""
+    delays = _delays(deadline, _wait_message(filename))
+    while True:
+        fd = _lock(filename, blocking=False)
+        if fd is not None:
+            return fd
+        time.sleep(next(delays))
+
+async def _wait_lock_async(filename: str, deadline: float) -> int:
+    """asynchronous variant of _wait_lock"""
+    delays = _delays(deadline, _wait_message(filename))
+    while True:
+        fd = _lock(filename, blocking=False)
+        if fd is not None:
+            return fd
+        await asyncio.sleep(next(delays))
+
+def _unlock(filename: str, fd: int):
+    # Removing the lock file is safe, as waiters re-check the cache entry once they get the lock.
+    try:
+        os.unlink(filename + '.lock')
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+
+def _render_missing(jobs: {}, renderer: Renderer) -> int:
+    """renders snippets of the filename->snippet dict which are not in the cache dir yet
+
+    Identical concurrent renders are deduplicated across threads and processes:
+    the first requester of a snippet takes its lock file in the cache dir and
+    renders it, the others wait for the lock and read the result. Returns the
+    number of snippets rendered by this call."""
+    locks, waiting = _lock_missing(jobs)
+    rendered = 0
+    try:
+        # Another renderer might have finished the entry before we took the lock.
+        owned = {filename: jobs[filename] for filename in locks if not os.path.exists(filename)}
+        if owned:
+            _render_into_cache(owned, renderer)
+            rendered += len(owned)
+        for filename in list(locks):
+            _unlock(filename, locks.pop(filename))
+
+        # Wait for the others. If they failed, render the remaining snippets
+        # ourselves. The locks are taken in sorted order, so requests waiting
+        # for the same snippets can't hold each other's locks.
+        deadline = time.monotonic() + RENDER_WAIT_TIMEOUT
+        for filename in sorted(waiting):
+            fd = _wait_lock(filename, deadline)
+            if os.path.exists(filename):
+                _unlock(filename, fd)
+            else:
+                locks[filename] = fd
+        remaining = {filename: waiting[filename] for filename in locks}
+        if remaining:
+            _render_into_cache(remaining, renderer)
+            rendered += len(remaining)
+    finally:
+        for filename, fd in locks.items():
+            _unlock(filename, fd)
+
+    return rendered
+
+def _lock_missing(jobs: {}) -> ({}, {}):
+    """takes the render locks of the jobs missing from the cache dir, if they are free
+
+    Returns the filename->lock dict of locked jobs and the filename->snippet
+    dict of jobs being rendered by somebody else."""
+    for dirname in {os.path.dirname(filename) for filename in jobs}:
+        os.makedirs(dirname, exist_ok=True)
+
+    missing = {filename: snippet for filename, snippet in jobs.items() if not os.path.exists(filename)}
+    cachedir.count(disk_hits=len(jobs)-len(missing), disk_misses=len(missing))
+
+    locks = {}
+    waiting = {}
+    for filename, snippet in missing.items():
+        fd = _lock(filename, blocking=False)
+        if fd is None:
+            waiting[filename] = snippet
+        else:
+            locks[filename] = fd
+    return locks, waiting
+
+async def _render_missing_async(jobs: {}, renderer: Renderer) -> int:
+    """asynchronous variant of _render_missing, which polls the locks of the snippets
+    rendered by others instead of blocking on them"""
+    locks, waiting = _lock_missing(jobs)
+    rendered = 0
+    try:
+        owned = {filename: jobs[filename] for filename in locks if not os.path.exists(filename)}
+        if owned:
+            await _render_into_cache_async(owned, renderer)
+            rendered += len(owned)
+        for filename in list(locks):
+            _unlock(filename, locks.pop(filename))
+
+        deadline = time.monotonic() + RENDER_WAIT_TIMEOUT
+        for filename in sorted(waiting):
+            fd = await _wait_lock_async(filename, deadline)
+            if os.path.exists(filename):
+                _unlock(filename, fd)
+            else:
+                locks[filename] = fd
+        remaining = {filename: waiting[filename] for filename in locks}
+        if remaining:
+            await _render_into_cache_async(remaining, renderer)
+            rendered += len(remaining)
+    finally:
+        for filename, fd in locks.items():
+            _unlock(filename, fd)
+
+    return rendered
+
+def prerender(snippets: [Snippet], renderer: Renderer = None) -> int:
+    """fills the cache dir with svg previews of the given snippets without reading them
+
+    Returns the number of snippets which had to be rendered."""
+    renderer = renderer or get_renderer()
+    return _render_missing({_cache_filename(s, renderer): s for s in snippets}, renderer)
+
+def _lookup_memory(snippets: [Snippet], renderer: Renderer) -> ([], [str], {}):
+    """returns memory cache keys, cached svgs or None and the filename->snippet dict of the others"""
+    keys = [(renderer.name, s.lilysrc) for s in snippets]
+    svgs = [memory_cache.get(key) for key in keys]
+    if None not in svgs:
+        cachedir.count()
+    jobs = {_cache_filename(s, renderer): s for s, svg in zip(snippets, svgs) if svg is None}
+    return keys, svgs, jobs
+
+def _read_rendered(snippets: [Snippet], renderer: Renderer, keys: [], svgs: [str]) -> [str]:
+    """reads svgs missing from the memory cache from the cache dir"""
+    for i, s in enumerate(snippets):
+        if svgs[i] is None:
+            filename = _cache_filename(s, renderer)
+            with open(filename, 'r') as file:
+                svgs[i] = file.read()
+            cachedir.touch(filename)
+            memory_cache.put(keys[i], svgs[i])
+    return svgs
+
+def generate_svgs(snippets: [Snippet], renderer: Renderer = None) -> [str]:
+    """returns svg previews of the given snippets
+    Recently used snippets are served from the in-memory cache, others are read
+    from the cache dir. The snippets missing from both are rendered first, by
+    lilypond in batches of at most RENDER_WORKERS concurrent invocations."""
+    renderer = renderer or get_renderer()
+    keys, svgs, jobs = _lookup_memory(snippets, renderer)
+    if jobs:
+        _render_missing(jobs, renderer)
+    return _read_rendered(snippets, renderer, keys, svgs)
+
+async def generate_svgs_async(snippets: [Snippet], renderer: Renderer = None) -> [str]:
+    """asynchronous variant of generate_svgs"""
+    renderer = renderer or get_renderer()
+    keys, svgs, jobs = _lookup_memory(snippets, renderer)
+    if not jobs:
+        return svgs
+    await _render_missing_async(jobs, renderer)
+    return await asyncio.to_thread(_read_rendered, snippets, renderer, keys, svgs)
+
+def generate_svg_keys(snippets: [Snippet], renderer: Renderer = None) -> [str]:
+    """renders the snippets missing from the cache dir and returns their cache keys
+
+    Used when svgs are referenced by URL instead of being inlined into the page."""
+    renderer = renderer or get_renderer()
+    _render_missing({_cache_filename(s, renderer): s for s in snippets}, renderer)
+    return [renderer.cache_key(s) for s in snippets]
+
+async def generate_svg_keys_async(snippets: [Snippet], renderer: Renderer = None) -> [str]:
+    """asynchronous variant of generate_svg_keys"""
+    renderer = renderer or get_renderer()
+    await _render_missing_async({_cache_filename(s, renderer): s for s in snippets}, renderer)
+    return [renderer.cache_key(s) for s in snippets]
+
+# Extensions of the precompressed variants of the svgs by content encoding.
+SVG_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+def read_svg(key: str, encodings: [str] = ()) -> (bytes, str):
+    """returns svg of the given cache key from the cache dir and its content encoding
+
+    The first precompressed variant whose encoding ('br' or 'gzip') is among
+    the given ones, in their order of preference, is returned and the plain svg
+    otherwise. Returns (None, None), if the svg is missing. Served variants are
+    kept in the memory cache."""
+    filename = os.path.join(CACHE_DIR, key) + '.preview.svg'
+    for encoding in [e for e in encodings if e in SVG_EXTENSIONS] + [None]:
+        data = memory_cache.get(('svg', key, encoding))
+        if data is not None:
+            return data, encoding
+        try:
+            with open(filename + SVG_EXTENSIONS.get(encoding, ''), 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            continue
+        cachedir.touch(filename)
+        memory_cache.put(('svg', key, encoding), data)
+        return data, encoding
+    return None, None
+
+def has_svg(key: str) -> bool:
+    """returns whether read_svg would find the svg of the given cache key"""
+    if any(('svg', key, encoding) in memory_cache for encoding in [None, *SVG_EXTENSIONS]):
+        return True
+    return os.path.exists(os.path.join(CACHE_DIR, key) + '.preview.svg')
 
-    with open(filename, 'r') as file:
-        return file.read()
+def generate_svg(snippet: Snippet, renderer: Renderer = None) -> str:
+    """returns svg preview of the given snippet"""
+    return generate_svgs([snippet], renderer)[0]
@@ -0,0 +1,209 @@
+"""Pool of long-lived lilypond processes
+
+Most of a lilypond invocation is spent starting guile and loading the init
+files and fonts. A worker pays that once: it runs a scheme loop which reads
+paths of .ly files from stdin, renders each one in its directory and replies
+with a status line on stdout. Workers are restarted after WORKER_MAX_JOBS
+renders, killed when a render exceeds WORKER_TIMEOUT and discarded after any
+failed render."""
+import atexit, os, selectors, signal, subprocess, threading, time
+
+from django.conf import settings
+
+# Maximum number of renders before a worker is restarted, which bounds the
+# memory leaked by lilypond between files.
+WORKER_MAX_JOBS = getattr(settings, 'NOTECHECK_LILYPOND_WORKER_MAX_JOBS', 200)
+
+# Seconds to wait for a worker to start or to render a single .ly file.
+WORKER_TIMEOUT = getattr(settings, 'NOTECHECK_RENDER_TIMEOUT', 30)
+
+# Seconds without workers after a failed start, doubled on every further
+# failure up to WORKER_RETRY_MAX_DELAY.
+WORKER_RETRY_DELAY = 1
+WORKER_RETRY_MAX_DELAY = 60
+
+READY = b'notecheck-ready'
+OK = b'notecheck-ok'
+ERROR = b'notecheck-error'
+
+# Evaluated by lilypond instead of processing the input files. Replies are
+# prefixed, since lilypond's own messages end up on the same pipe.
+WORKER_SCHEME = """
+(use-modules (ice-9 rdelim))
+(display "\\nnotecheck-ready\\n")
+(force-output)
+(let loop ((filename (read-line)))
+  (if (not (eof-object? filename))
+    (let ((ok (catch #t
+                (lambda ()
+                  (chdir (dirname filename))
+                  (ly:parse-file filename)
+                  #t)
+                (lambda args #f))))
+      (ly:clear-anonymous-modules)
+      (display (if ok "\\nnotecheck-ok\\n" "\\nnotecheck-error\\n"))
+      (force-output)
+      (loop (read-line)))))
+(exit 0)
+"""
+
+WORKER_CMD = ['lilypond', '-dbackend=svg', '-dno-point-and-click', '-dpreview', '-e', WORKER_SCHEME]
+
+class WorkerError(Exception):
+    pass
+
+class WorkerTimeout(WorkerError):
+    pass
+
+class WorkerUnsupported(WorkerError):
+    """lilypond exited before running the scheme loop"""
+
+class Worker:
+    """A single lilypond process rendering .ly files one by one"""
+
+    def __init__(self):
+        self.process = subprocess.Popen(
+            WORKER_CMD,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            start_new_session=True, # kill lilypond together with its children
+        )
+        self.jobs = 0
+        self._buffer = b''
+        try:
+            self._read_reply(READY)
+        except WorkerTimeout:
+            self.kill()
+            raise
+        except WorkerError as e:
+            self.kill()
+            raise WorkerUnsupported(str(e))
+
+    def _read_reply(self, *replies: bytes) -> (bytes, bytes):
+        """reads worker's output until one of the replies, returns the reply and the output before it"""
+        deadline = time.monotonic() + WORKER_TIMEOUT
+        fd = self.process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                for reply in replies:
+                    i = self._buffer.find(b'\n' + reply + b'\n')
+                    if i != -1:
+                        output = self._buffer[:i]
+                        self._buffer = self._buffer[i+len(reply)+2:]
+                        return reply, output
+
+                timeout = deadline - time.monotonic()
+                if timeout <= 0 or not selector.select(timeout):
+                    raise WorkerTimeout('lilypond worker timed out after {}s'.format(WORKER_TIMEOUT))
+                data = os.read(fd, 65536)
+                if not data:
+                    raise WorkerError('lilypond worker exited: {}'.format(self._buffer.decode('utf-8', 'replace')))
+                self._buffer += data
+
+    def render(self, filename: str) -> bytes:
+        """renders the .ly file into its directory and returns lilypond's output"""
+        self.jobs += 1
+        try:
+            self.process.stdin.write(filename.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+            reply, output = self._read_reply(OK, ERROR)
+        except WorkerTimeout:
+            self.kill()
+            raise
+        except (OSError, WorkerError) as e:
+            self.kill()
+            raise WorkerError('lilypond worker failed rendering {}: {}'.format(filename, e))
+        if reply == ERROR:
+            raise WorkerError(output.decode('utf-8', 'replace'))
+        return output
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def close(self):
+        """lets the worker finish its loop and exit"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(WORKER_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+    def kill(self):
+        if self.process.returncode is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+
+class WorkerPool:
+    """Idle workers shared by the render threads of a process
+
+    Workers are started on demand, so the pool never holds more workers than
+    the number of concurrent renders. While it isn't available, the callers
+    fall back to a lilypond process per batch: for good, if the installed
+    lilypond doesn't support the scheme loop, and for a backoff delay after
+    other failed starts, e.g. timeouts under load."""
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+        self.supported = True
+        self.started = 0
+        self._retry_delay = 0
+        self._retry_at = 0
+
+    @property
+    def available(self) -> bool:
+        return self.supported and time.monotonic() >= self._retry_at
+
+    def _start(self) -> Worker:
+        try:
+            worker = Worker()
+        except WorkerUnsupported as e:
+            self.supported = False
+            raise WorkerError('lilypond worker is not supported: {}'.format(e))
+        except (OSError, WorkerError) as e:
+            with self._lock:
+                self._retry_delay = min(max(2*self._retry_delay, WORKER_RETRY_DELAY), WORKER_RETRY_MAX_DELAY)
+                self._retry_at = time.monotonic() + self._retry_delay
+            raise WorkerError('lilypond worker could not be started, retrying in {}s: {}'.format(self._retry_delay, e))
+        with self._lock:
+            self._retry_delay = 0
+            self.started += 1
+        return worker
+
+    def render(self, filename: str) -> bytes:
+        """renders the .ly file on an idle or a new worker and returns lilypond's output"""
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = self._start()
+
+        try:
+            output = worker.render(filename)
+        except BaseException:
+            # Whatever went wrong may have left lilypond in a broken state.
+            worker.kill()
+            raise
+
+        if worker.alive() and worker.jobs < WORKER_MAX_JOBS:
+            with self._lock:
+                self._idle.append(worker)
+        else:
+            worker.close()
+        return output
+
+    def close(self):
+        """stops all idle workers"""
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for worker in workers:
+            worker.close()
+
+pool = WorkerPool()
+atexit.register(pool.close)
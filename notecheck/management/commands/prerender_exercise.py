@@ -0,0 +1,62 @@
+import time
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from notecheck.lilypond import Snippet, interval_snippet, note_snippet, prerender, scale_snippet
+from notecheck.models import Exercise, IntervalExercise, NotePitchExercise, ScaleExercise
+
+def get_exercise_snippets(ex: Exercise) -> [Snippet]:
+    """return lilypond snippets of all questions the given exercise can produce"""
+    snippets = []
+    for clef in ex.get_clefs():
+        if isinstance(ex, NotePitchExercise):
+            snippets += [note_snippet(clef, p) for p in ex.get_candidate_pitches(clef)]
+        elif isinstance(ex, IntervalExercise):
+            snippets += [interval_snippet(clef, p1, p2) for p1, p2 in ex.get_candidate_pitch_pairs(clef)]
+        elif isinstance(ex, ScaleExercise):
+            snippets += [scale_snippet(clef, s[0], s[-1]) for s in ex.get_candidate_scales(clef)]
+        else:
+            raise TypeError()
+
+    # Different scales can share the first and the last note.
+    return list({s.lilysrc: s for s in snippets}.values())
+
+class Command(BaseCommand):
+    help = 'Renders svgs of all questions the given exercises can produce into the cache dir.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tokens', nargs='*', help='Exercise tokens.')
+        parser.add_argument('--all', action='store_true', help='Prerender all active exercises.')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Number of snippets rendered between progress reports (default 100).')
+
+    def handle(self, *args, **options):
+        if options['all']:
+            exercises = list(Exercise.objects.filter(active=True))
+        elif options['tokens']:
+            try:
+                exercises = list(Exercise.objects.filter(token__in=options['tokens']))
+            except ValidationError as e:
+                raise CommandError(e.messages[0])
+            found = {str(ex.token) for ex in exercises}
+            for token in options['tokens']:
+                if token not in found:
+                    raise CommandError('Exercise {} does not exist.'.format(token))
+        else:
+            raise CommandError('Provide exercise tokens or --all.')
+
+        batch_size = options['batch_size']
+        for ex in exercises:
+            ex = ex.get_instance()
+            snippets = get_exercise_snippets(ex)
+            start = time.time()
+            rendered = 0
+            for i in range(0, len(snippets), batch_size):
+                rendered += prerender(snippets[i:i+batch_size])
+                self.stdout.write('\r{} ({}): {}/{}'.format(
+                    ex.title, ex.token, min(i+batch_size, len(snippets)), len(snippets)), ending='')
+                self.stdout.flush()
+
+            self.stdout.write('\r{} ({}): {} snippets, {} rendered in {:.1f}s'.format(
+                ex.title, ex.token, len(snippets), rendered, time.time()-start))
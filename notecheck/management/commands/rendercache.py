@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from notecheck import cachedir, lilypond
+
+def _format_bytes(n: int) -> str:
+    for unit in ['B', 'kB', 'MB']:
+        if n < 1024:
+            return '{:.0f}{}'.format(n, unit)
+        n /= 1024
+    return '{:.1f}GB'.format(n)
+
+def _ratio(hits: int, misses: int) -> str:
+    if hits+misses == 0:
+        return '-'
+    return '{:.1%}'.format(hits/(hits+misses))
+
+class Command(BaseCommand):
+    help = 'Reports and maintains the cache dir of rendered question svgs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['stats', 'prune', 'clear'],
+                            help='stats: report usage and hit ratios, prune: remove old generations and '
+                                 'evict least recently used svgs over the budget, clear: remove everything.')
+        parser.add_argument('--max-bytes', type=int, default=None,
+                            help='Size budget for prune (default NOTECHECK_CACHE_MAX_BYTES).')
+
+    def handle(self, *args, **options):
+        if options['action'] == 'prune':
+            entries, size = cachedir.prune(options['max_bytes'])
+            self.stdout.write('Removed {} svgs, {}.'.format(entries, _format_bytes(size)))
+        elif options['action'] == 'clear':
+            cachedir.clear()
+            self.stdout.write('Cleared {}.'.format(lilypond.CACHE_DIR))
+        else:
+            stats = cachedir.cache_stats()
+            self.stdout.write('Cache dir: {}'.format(lilypond.CACHE_DIR))
+            for g in stats['generations']:
+                self.stdout.write('  {}{}: {} svgs, {}'.format(
+                    g['name'], '' if g['current'] else ' (old)', g['entries'], _format_bytes(g['bytes'])))
+            self.stdout.write('Total: {} svgs, {} of {}'.format(
+                stats['entries'], _format_bytes(stats['bytes']), _format_bytes(stats['max_bytes'])))
+            self.stdout.write('Memory hit ratio: {} ({} hits, {} misses)'.format(
+                _ratio(stats['memory_hits'], stats['memory_misses']), stats['memory_hits'], stats['memory_misses']))
+            self.stdout.write('Disk hit ratio: {} ({} hits, {} misses)'.format(
+                _ratio(stats['disk_hits'], stats['disk_misses']), stats['disk_hits'], stats['disk_misses']))
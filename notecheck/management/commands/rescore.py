@@ -0,0 +1,27 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from notecheck import scoring
+from notecheck.models import Exercise
+
+class Command(BaseCommand):
+    help = 'Stores scores of the finalized submissions which were submitted before the scores were stored.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rescore all finalized submissions, not only the missing ones.')
+        parser.add_argument('--exercise', metavar='TOKEN', help='Rescore submissions of the given exercise only.')
+        parser.add_argument('--chunk-size', type=int, default=scoring.CHUNK_SIZE, help='Submissions scored and saved at once.')
+
+    def handle(self, *args, **options):
+        exercise = None
+        if options['exercise']:
+            try:
+                exercise = Exercise.objects.get(token=options['exercise'])
+            except (Exercise.DoesNotExist, ValidationError):
+                raise CommandError('Exercise {} does not exist.'.format(options['exercise']))
+
+        submissions = scoring.finalized_submissions(exercise, missing=not options['all'])
+        count, seconds = scoring.rescore(submissions, chunk_size=options['chunk_size'])
+
+        self.stdout.write('Rescored {} submissions in {:.2f}s ({:.0f} submissions/s).'.format(
+            count, seconds, count / seconds if seconds else 0))
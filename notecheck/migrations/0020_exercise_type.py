@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def backfill_type(apps, schema_editor):
+    Exercise = apps.get_model('notecheck', 'Exercise')
+    for model_name, type in [('NotePitchExercise', 'notepitch'), ('IntervalExercise', 'interval'), ('ScaleExercise', 'scale')]:
+        e_class = apps.get_model('notecheck', model_name)
+        Exercise.objects.filter(token__in=e_class.objects.values('pk')).update(type=type)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notecheck', '0019_auto_20241008_2253'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exercise',
+            name='type',
+            field=models.CharField(choices=[('notepitch', 'Note pitch'), ('interval', 'Interval'), ('scale', 'Scale')], default='', editable=False, max_length=20),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_type, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notecheck', '0020_exercise_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='score',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='max_score',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='score_vector',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
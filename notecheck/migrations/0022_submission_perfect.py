@@ -0,0 +1,29 @@
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_perfect(apps, schema_editor):
+    # Submissions without a stored score are scored by `manage.py rescore`,
+    # which needs the question generators and is a required upgrade step.
+    Submission = apps.get_model('notecheck', 'Submission')
+    Submission.objects.filter(score__isnull=False, score=F('max_score')).update(perfect=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notecheck', '0021_submission_score'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='perfect',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='submission',
+            index=models.Index(fields=['token', 'perfect', 'duration'], name='notecheck_besttime_idx'),
+        ),
+        migrations.RunPython(backfill_perfect, migrations.RunPython.noop),
+    ]
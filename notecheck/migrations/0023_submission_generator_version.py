@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notecheck', '0022_submission_perfect'),
+    ]
+
+    operations = [
+        # Existing submissions keep the questions of the first generators.
+        migrations.AddField(
+            model_name='submission',
+            name='generator_version',
+            field=models.PositiveSmallIntegerField(default=1, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='submission',
+            name='generator_version',
+            field=models.PositiveSmallIntegerField(default=2, editable=False),
+        ),
+    ]
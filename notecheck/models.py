@@ -1,3 +1,5 @@
+import csv
+import functools
 import math
 from datetime import timedelta
 import random
@@ -6,35 +8,101 @@ import uuid
 
 from django.conf import settings
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.urls import reverse
+from django.db.models import Min
+from django.http import JsonResponse, StreamingHttpResponse
+from django.urls import path, reverse
 from django.utils.safestring import mark_safe
 from django.utils.translation import gettext_lazy as _
 
+from . import intervals
+
+def memoize(key):
+    """cache the method's results on the instance by key(self, *args)
+
+    Used for the questions and answers generated from the submission's seed,
+    which are needed many times while handling a single request."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            memo = self.__dict__.setdefault('_memo', {})
+            k = (method.__name__, key(self, *args, **kwargs))
+            if k not in memo:
+                memo[k] = method(self, *args, **kwargs)
+            return memo[k]
+        return wrapper
+    return decorator
+
+_questions_key = lambda self: (self.seed, self.token_id, self.generator_version)
+_answers_key = lambda self, lang: (self.seed, self.token_id, lang)
+_score_key = lambda self, lang: (self.seed, self.token_id, lang, tuple(self.answers or ()))
+
+# Exercise settings the candidate questions depend on.
+_candidates_key = lambda self, clef: (clef, tuple(getattr(self, f.attname) for f in self._meta.concrete_fields))
+
+class Candidates:
+    """All questions an exercise can ask in a clef, drawn in constant time"""
+
+    def __init__(self, questions: [], key=None):
+        self.questions = questions
+        self.key = key
+        self.index = {(key(q) if key else q): i for i, q in enumerate(questions)}
+
+    def draw(self, rnd: random.Random, old=None):
+        """return a random question other than old, unless it's the only one"""
+        i = self.index.get(self.key(old) if self.key and old is not None else old)
+        if i is None or len(self.questions) == 1:
+            return self.questions[rnd.randrange(len(self.questions))]
+        j = rnd.randrange(len(self.questions) - 1)
+        return self.questions[j + (j >= i)]
+
 class Clefs(models.TextChoices):
     TREBLE = 'treble', _('Treble')
     BASS = 'bass', _('Bass')
     TREBLE_BASS = 'treblebass', _('Treble and bass')
 
+class ExerciseTypes(models.TextChoices):
+    NOTE_PITCH = 'notepitch', _('Note pitch')
+    INTERVAL = 'interval', _('Interval')
+    SCALE = 'scale', _('Scale')
+
 class Exercise(models.Model):
+    TYPE: ExerciseTypes = None # set by the concrete exercises
+
     token = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    type = models.CharField(max_length=20, choices=ExerciseTypes.choices, editable=False)
     active = models.BooleanField(default=True)
     title = models.CharField(max_length=100)
     created = models.DateTimeField('date published', auto_now=True)
     num_questions = models.IntegerField(default=20)
 
+    def save(self, *args, **kwargs):
+        if self.TYPE:
+            self.type = self.TYPE
+        super().save(*args, **kwargs)
+
     def get_instance(self):
-        """hack which returns a concrete implementation of exercise"""
-        for e_class in [NotePitchExercise, IntervalExercise, ScaleExercise]:
-            if e_class.objects.filter(token=self.token):
-                return e_class.objects.get(token=self.token)
+        """return the concrete implementation of exercise
 
-        raise TypeError()
+        The child row is fetched by the one-to-one accessor of the exercise type,
+        which is free if it was select_related (see EXERCISE_RELATED)."""
+        if type(self) is not Exercise:
+            return self
+        if self.type not in EXERCISE_CLASSES:
+            raise TypeError()
+        return getattr(self, EXERCISE_CLASSES[self.type]._meta.model_name)
 
     def get_title(self):
         return ""
 
+    def get_clefs(self) -> [Clefs]:
+        """return all clefs the questions can be written in"""
+        if self.clef == Clefs.TREBLE_BASS:
+            return [Clefs.TREBLE, Clefs.BASS]
+        return [Clefs(self.clef)]
+
 class ExerciseAdmin(admin.ModelAdmin):
     list_display = ('title', 'token', 'created', 'num_questions', 'share')
 
@@ -47,6 +115,7 @@ class NotePitchAnswerTypes(models.TextChoices):
     NOTENAME = 'notename', _('Note pitch only (e.g. fis)')
 
 class NotePitchExercise(Exercise):
+    TYPE = ExerciseTypes.NOTE_PITCH
     AMBITUS = {
         Clefs.TREBLE: (25, 45),
         Clefs.BASS: (12, 33),
@@ -59,6 +128,18 @@ class NotePitchExercise(Exercise):
     def get_title(self):
         return NotePitchAnswerTypes(self.answer_type).label
 
+    def get_candidate_pitches(self, clef: Clefs) -> ['DiatonicPitch']:
+        """return all pitches which can be asked in the given clef"""
+        ambitus = NotePitchExercise.AMBITUS[clef]
+        accs_range = [0]
+        if self.max_sharps != 0 or self.max_flats != 0:
+            accs_range = range(-self.max_flats, self.max_sharps+1)
+        return [DiatonicPitch(p, accs) for p in range(ambitus[0], ambitus[1]) for accs in accs_range]
+
+    @memoize(_candidates_key)
+    def get_candidates(self, clef: Clefs) -> Candidates:
+        return Candidates(self.get_candidate_pitches(clef))
+
 @admin.register(NotePitchExercise)
 class NotePitchExerciseAdmin(ExerciseAdmin):
     pass
@@ -70,6 +151,7 @@ class IntervalAnswerTypes(models.TextChoices):
     SEMITONES = 'semitones', _('Semitones (e.g. 5)')
 
 class IntervalExercise(Exercise):
+    TYPE = ExerciseTypes.INTERVAL
     AMBITUS = {
         Clefs.TREBLE: (25, 45),
         Clefs.BASS: (12, 33),
@@ -84,6 +166,41 @@ class IntervalExercise(Exercise):
     def get_title(self):
         return IntervalAnswerTypes(self.answer_type).label
 
+    def is_valid_interval(self, interval: 'Interval') -> bool:
+        """check interval against the max quantity, direction and quality constraints of the exercise"""
+        return (self.max_quantity == 0 or abs(interval.quantity) <= self.max_quantity) and \
+               (self.direction == 0 or interval.quantity / abs(interval.quantity) == self.direction) and \
+               interval.quality >= -2 and interval.quality <= 2
+
+    def get_candidate_pitch_pairs(self, clef: Clefs) -> [('DiatonicPitch', 'DiatonicPitch')]:
+        """return all pitch pairs which can be asked in the given clef"""
+        ambitus = IntervalExercise.AMBITUS[clef]
+        accs_range = [0]
+        if self.max_sharps != 0 or self.max_flats != 0:
+            accs_range = range(-self.max_flats, self.max_sharps+1)
+        pitches = [DiatonicPitch(p, accs) for p in range(ambitus[0], ambitus[1]) for accs in accs_range]
+        if intervals.numpy is None:
+            return [(p1, p2) for p1 in pitches for p2 in pitches
+                    if self.is_valid_interval(Interval.from_diatonic_pitches((p1, p2), False))]
+
+        # Same as above, but the intervals of all pairs are computed at once.
+        np = intervals.numpy
+        first, second = np.divmod(np.arange(len(pitches)**2), len(pitches))
+        pitch_array = np.array([p.pitch for p in pitches])
+        accs_array = np.array([p.accs for p in pitches])
+        quantities, qualities, _ = intervals.intervals(
+            pitch_array[first], accs_array[first], pitch_array[second], accs_array[second], absolute=False)
+        valid = (qualities >= -2) & (qualities <= 2)
+        if self.max_quantity != 0:
+            valid &= np.abs(quantities) <= self.max_quantity
+        if self.direction != 0:
+            valid &= np.sign(quantities) == self.direction
+        return [(pitches[i], pitches[j]) for i, j in zip(first[valid].tolist(), second[valid].tolist())]
+
+    @memoize(_candidates_key)
+    def get_candidates(self, clef: Clefs) -> Candidates:
+        return Candidates(self.get_candidate_pitch_pairs(clef))
+
 @admin.register(IntervalExercise)
 class IntervalExerciseAdmin(ExerciseAdmin):
     pass
@@ -98,6 +215,7 @@ class ScaleShape(models.TextChoices):
     MELODIC = 'melodic', _('Melodic')
 
 class ScaleExercise(Exercise):
+    TYPE = ExerciseTypes.SCALE
     AMBITUS = { # At most one semiline below and above the staff.
         Clefs.TREBLE: (27, 41),
         Clefs.BASS: (15, 29),
@@ -112,10 +230,38 @@ class ScaleExercise(Exercise):
     def get_title(self):
         return "{gender} {shape}".format(gender=ScaleGender(self.gender).label, shape=ScaleShape(self.shape).label)
 
+    def get_scale(self, clef: Clefs, accs: int, direction: int) -> ['DiatonicPitch']:
+        """return pitches of the scale with the given key signature starting in the lowest octave within ambitus"""
+        ambitus = ScaleExercise.AMBITUS[clef]
+        pitches = Scale(self.gender, self.shape, accs).get_pitches()
+
+        # Find start pitch octave.
+        offset = 0
+        while pitches[0].pitch+offset < ambitus[0]:
+            offset += 7
+
+        if direction == -1:
+            pitches.reverse()
+
+        return [DiatonicPitch(p.pitch+offset, p.accs) for p in pitches]
+
+    def get_candidate_scales(self, clef: Clefs) -> [['DiatonicPitch']]:
+        """return all scales which can be asked in the given clef"""
+        directions = [self.direction] if self.direction != 0 else [-1, 1]
+        return [self.get_scale(clef, accs, direction)
+                for accs in range(-self.max_flats, self.max_sharps+1) for direction in directions]
+
+    @memoize(_candidates_key)
+    def get_candidates(self, clef: Clefs) -> Candidates:
+        return Candidates(self.get_candidate_scales(clef), key=tuple)
+
 @admin.register(ScaleExercise)
 class ScaleExerciseAdmin(ExerciseAdmin):
     pass
 
+# Generator version of the new submissions, see Submission.generator_version.
+GENERATOR_VERSION = 2
+
 class Submission(models.Model):
     token = models.ForeignKey(Exercise, on_delete=models.CASCADE)
     seed = models.IntegerField(default=0)
@@ -123,15 +269,52 @@ class Submission(models.Model):
     created = models.DateTimeField('submission created date', auto_now=True)
     duration = models.DurationField(default=timedelta(0))
 
+    # Stored when the submission is finalized, scored in settings.LANGUAGE_CODE.
+    score = models.PositiveSmallIntegerField(null=True, blank=True)
+    max_score = models.PositiveSmallIntegerField(null=True, blank=True)
+    score_vector = models.JSONField(null=True, blank=True)
+    perfect = models.BooleanField(default=False)
+
+    # Questions are generated from the seed by the generators of this version,
+    # so that older submissions keep their questions. Version 1 draws random
+    # questions until they satisfy the exercise, version 2 draws from the
+    # exercise's candidates.
+    generator_version = models.PositiveSmallIntegerField(default=GENERATOR_VERSION, editable=False)
+
+    class Meta:
+        indexes = [
+            # Best time and leaderboard of an exercise.
+            models.Index(fields=['token', 'perfect', 'duration'], name='notecheck_besttime_idx'),
+        ]
+
+    @staticmethod
+    def get_perfect(token) -> models.QuerySet:
+        """return finalized submissions of the exercise with full score, using the best time index"""
+        return Submission.objects.filter(token=token, perfect=True, duration__gt=timedelta(0))
+
     def get_instance(self):
-        """hack which returns a concrete implementation of submission"""
-        if NotePitchExercise.objects.filter(token=self.token.token):
-            return NotePitchSubmission.objects.get(pk=self.pk)
-        elif IntervalExercise.objects.filter(token=self.token.token):
-            return IntervalSubmission.objects.get(pk=self.pk)
-        elif ScaleExercise.objects.filter(token=self.token.token):
-            return ScaleSubmission.objects.get(pk=self.pk)
-        raise TypeError()
+        """return the concrete implementation of submission without querying the database again"""
+        if type(self) is not Submission:
+            return self
+        if self.token.type not in SUBMISSION_CLASSES:
+            raise TypeError()
+
+        # Proxy sharing the instance's state: the loaded fields, the cached
+        # exercise and the memoized questions and answers. It isn't kept in
+        # that state, which copies and pickles of the instance don't share.
+        submission = object.__new__(SUBMISSION_CLASSES[self.token.type])
+        submission.__dict__ = self.__dict__
+        return submission
+
+    def draw_questions(self, ex: Exercise) -> []:
+        """return questions drawn from the exercise's candidates, generator version 2"""
+        rnd = random.Random(self.seed)
+        questions = []
+        question = None
+        for i in range(ex.num_questions):
+            question = ex.get_candidates(self.get_clef(ex, i)).draw(rnd, question)
+            questions.append(question)
+        return questions
 
     def get_clef(self, ex: NotePitchExercise, i: int) -> Clefs:
         """return randomized clef, if Treble and Bass is selected"""
@@ -144,19 +327,45 @@ class Submission(models.Model):
         """return expected answers used as a helper in admin pages"""
         return self.get_instance().get_expected_answers(lang=lang)
 
+    def has_stored_score(self, lang: str) -> bool:
+        return self.score_vector is not None and lang == settings.LANGUAGE_CODE
+
     def get_score(self, lang: str) -> int:
         """return number of correct answers"""
-        return self.get_instance().get_score_vector(lang).count(1)
+        if self.has_stored_score(lang):
+            return self.score
+        return self.get_score_vector(lang).count(1)
+
+    def get_max_score(self, lang: str) -> int:
+        """return number of answers"""
+        if self.has_stored_score(lang):
+            return self.max_score
+        return len(self.get_expected_answers(lang))
 
     def get_score_vector(self, lang: str) -> []:
         """return binary array of correct/incorrect answers"""
-        return self.get_instance().get_score_vector(lang=lang)
+        if self.has_stored_score(lang):
+            return self.score_vector
+        return self.get_instance().compute_score_vector(lang=lang)
+
+    def store_score(self):
+        """compute the score of the finalized answers and store it in the score fields"""
+        lang = settings.LANGUAGE_CODE
+        self.score_vector = [bool(c) for c in self.get_instance().compute_score_vector(lang=lang)]
+        self.score = self.score_vector.count(True)
+        self.max_score = len(self.get_expected_answers(lang))
+        self.perfect = self.score == self.max_score
 
     def get_besttime(self, lang: str) -> timedelta:
         """return the best time among the submissions with full score"""
+        if lang == settings.LANGUAGE_CODE:
+            best_time = Submission.get_perfect(self.token_id).aggregate(Min('duration'))['duration__min']
+            return best_time or timedelta.max
+
         best_time = timedelta.max
-        for s in Submission.objects.filter(token=self.token).exclude(duration=timedelta(0)):
-            if s.get_score(lang=lang)==len(s.get_expected_answers(lang=lang)) and s.duration < best_time:
+        submissions = Submission.objects.select_related('token', *['token__' + r for r in EXERCISE_RELATED])
+        for s in submissions.filter(token=self.token).exclude(duration=timedelta(0)):
+            if s.get_score(lang=lang)==s.get_max_score(lang=lang) and s.duration < best_time:
                 best_time = s.duration
 
         return best_time
@@ -166,19 +375,74 @@ class Submission(models.Model):
 class SubmissionAdmin(admin.ModelAdmin):
     list_display = ('name', 'created', 'duration', 'view_score', 'view')
     list_filter = ['token']
+    # Derived from the answers, see save_model.
+    readonly_fields = ('score', 'max_score', 'score_vector', 'perfect')
+    EXPORT_FIELDS = ['id', 'exercise', 'token', 'created', 'duration', 'score', 'max_score']
 
     def get_queryset(self, request):
-        # Hide submissions which weren't submitted yet.
-        return super(SubmissionAdmin, self).get_queryset(request).filter(duration__gt=timedelta(0))
-
-    @admin.display(description='Exercise')
+        # Hide submissions which weren't submitted yet. Concrete exercises are
+        # fetched along, in case the score of an old submission isn't stored.
+        return super(SubmissionAdmin, self).get_queryset(request) \
+            .filter(duration__gt=timedelta(0)) \
+            .select_related('token', *['token__' + r for r in EXERCISE_RELATED])
+
+    def save_model(self, request, obj, form, change):
+        # Edited answers invalidate the stored score.
+        if obj.duration > timedelta(0):
+            obj.store_score()
+        super().save_model(request, obj, form, change)
+
+    def get_urls(self):
+        return [
+            path('export.csv', self.admin_site.admin_view(self.export_csv), name='notecheck_submission_export_csv'),
+            path('export.json', self.admin_site.admin_view(self.export_json), name='notecheck_submission_export_json'),
+        ] + super().get_urls()
+
+    def get_export_rows(self, request):
+        """yield the submissions of the changelist with the current filters as dicts"""
+        queryset = self.get_changelist_instance(request).get_queryset(request)
+        for obj in queryset.iterator():
+            yield {
+                'id': obj.pk,
+                'exercise': obj.token.title,
+                'token': str(obj.token_id),
+                'created': obj.created.isoformat(),
+                'duration': obj.duration.total_seconds(),
+                'score': obj.get_score(lang=settings.LANGUAGE_CODE),
+                'max_score': obj.get_max_score(lang=settings.LANGUAGE_CODE),
+            }
+
+    def export_csv(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+
+        class Echo:
+            def write(self, value):
+                return value
+
+        def lines():
+            writer = csv.DictWriter(Echo(), fieldnames=self.EXPORT_FIELDS)
+            yield writer.writeheader()
+            for row in self.get_export_rows(request):
+                yield writer.writerow(row)
+
+        response = StreamingHttpResponse(lines(), content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="submissions.csv"'
+        return response
+
+    def export_json(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return JsonResponse(list(self.get_export_rows(request)), safe=False)
+
+    @admin.display(description='Exercise', ordering='token__title')
     def name(self, obj) -> str:
         return "{} ({})".format(obj.token.title, str(obj.token.token)[:8])
 
-    @admin.display(description='Score')
+    @admin.display(description='Score', ordering='score')
     def view_score(self, obj) -> str:
         if obj.duration:
-            return "{} / {}".format(obj.get_instance().get_score(lang=settings.LANGUAGE_CODE), len(obj.get_expected_answers(lang=settings.LANGUAGE_CODE)))
+            return "{} / {}".format(obj.get_score(lang=settings.LANGUAGE_CODE), obj.get_max_score(lang=settings.LANGUAGE_CODE))
         else:
             return ""
 
@@ -190,9 +454,12 @@ class NotePitchSubmission(Submission):
     class Meta:
         proxy = True
 
+    @memoize(_questions_key)
     def get_pitches(self) -> []:
         """return pitch instances generated from the seed"""
-        ex = NotePitchExercise.objects.get(token=self.token.token)
+        ex = self.token.get_instance()
+        if self.generator_version >= 2:
+            return self.draw_questions(ex)
 
         rnd = random.Random(self.seed)
         notes = []
@@ -215,13 +482,15 @@ class NotePitchSubmission(Submission):
 
         return notes
 
+    @memoize(_answers_key)
     def get_expected_answers(self, lang: str) -> []:
         pitches_str = []
         for i, p in enumerate(self.get_pitches()):
             pitches_str.append(p.to_name(lang))
         return pitches_str
 
-    def get_score_vector(self, lang: str) -> []:
+    @memoize(_score_key)
+    def compute_score_vector(self, lang: str) -> []:
         answer_type = self.token.get_instance().answer_type
         pitches = self.get_pitches()
         correct_vec = []
@@ -235,7 +504,7 @@ class NotePitchSubmission(Submission):
                 expected_pitch = DiatonicPitch(pitch=pitches[i].pitch % 7, accs=pitches[i].accs)
                 answered_pitch = DiatonicPitch.from_name(s, lang=lang)
                 if answered_pitch:
-                    answered_pitch.pitch %= 7
+                    answered_pitch = DiatonicPitch(answered_pitch.pitch % 7, answered_pitch.accs)
                 correct = expected_pitch==answered_pitch
 
             correct_vec.append(correct)
@@ -245,9 +514,12 @@ class IntervalSubmission(Submission):
     class Meta:
         proxy = True
 
+    @memoize(_questions_key)
     def get_pitch_pairs(self) -> []:
         """return pitch pairs generated from the seed"""
         ex = self.token.get_instance()
+        if self.generator_version >= 2:
+            return self.draw_questions(ex)
         rnd = random.Random(self.seed)
 
         pitch_pairs = []
@@ -259,18 +531,19 @@ class IntervalSubmission(Submission):
 
             # Avoid the same note pairs one after another.
             while old_pitch_pair == pitch_pair:
-                pitch1 = DiatonicPitch(rnd.randrange(ambitus[0],ambitus[1]), 0)
-                pitch2 = DiatonicPitch(rnd.randrange(ambitus[0],ambitus[1]), 0)
+                p1 = rnd.randrange(ambitus[0],ambitus[1])
+                p2 = rnd.randrange(ambitus[0],ambitus[1])
+                accs1 = accs2 = 0
 
                 if ex.max_sharps != 0 or ex.max_flats != 0:
-                    pitch1.accs = rnd.randrange(-ex.max_flats, ex.max_sharps+1)
-                    pitch2.accs = rnd.randrange(-ex.max_flats, ex.max_sharps+1)
+                    accs1 = rnd.randrange(-ex.max_flats, ex.max_sharps+1)
+                    accs2 = rnd.randrange(-ex.max_flats, ex.max_sharps+1)
+
+                pitch1 = DiatonicPitch(p1, accs1)
+                pitch2 = DiatonicPitch(p2, accs2)
 
                 # Check other exercise constraints.
-                interval_candidate = Interval.from_diatonic_pitches((pitch1, pitch2), False)
-                if (ex.max_quantity == 0 or abs(interval_candidate.quantity) <= ex.max_quantity) and \
-                   (ex.direction == 0 or interval_candidate.quantity / abs(interval_candidate.quantity) == ex.direction) and \
-                   interval_candidate.quality >= -2 and interval_candidate.quality <= 2:
+                if ex.is_valid_interval(Interval.from_diatonic_pitches((pitch1, pitch2), False)):
                     pitch_pair = (pitch1, pitch2)
 
             pitch_pairs.append( pitch_pair )
@@ -278,6 +551,7 @@ class IntervalSubmission(Submission):
 
         return pitch_pairs
 
+    @memoize(_answers_key)
     def get_expected_answers(self, lang: str) -> []:
         answer_type = self.token.get_instance().answer_type
         expected_answers = []
@@ -294,7 +568,8 @@ class IntervalSubmission(Submission):
                 raise TypeError()
         return expected_answers
 
-    def get_score_vector(self, lang: str) -> []:
+    @memoize(_score_key)
+    def compute_score_vector(self, lang: str) -> []:
         pitch_pairs = self.get_pitch_pairs()
         answer_type = self.token.get_instance().answer_type
         correct_vec = []
@@ -318,9 +593,12 @@ class ScaleSubmission(Submission):
     class Meta:
         proxy = True
 
+    @memoize(_questions_key)
     def get_scales(self) -> [ ['DiatonicPitch'] ]:
         """return scales generated from the seed"""
         ex = self.token.get_instance()
+        if self.generator_version >= 2:
+            return self.draw_questions(ex)
         rnd = random.Random(self.seed)
 
         scales: [ [DiatonicPitch] ] = []
@@ -328,33 +606,21 @@ class ScaleSubmission(Submission):
         old_scale: [DiatonicPitch] = None
         for i in range(ex.num_questions):
             clef = self.get_clef(ex, i)
-            ambitus = ScaleExercise.AMBITUS[clef]
             # Avoid the same note pairs one after another.
             while old_scale == scale:
-                scale = []
                 accs = rnd.randrange(-ex.max_flats, ex.max_sharps + 1)
-                s = Scale( ex.gender, ex.shape, accs )
-                pitches = s.get_pitches()
                 direction = ex.direction
                 if direction == 0:
                     direction = rnd.choice([-1, 1])
 
-                # Find start pitch octave.
-                offset = 0
-                while pitches[0].pitch+offset < ambitus[0]:
-                    offset += 7
-
-                if direction == -1:
-                    pitches.reverse()
-
-                for p in pitches:
-                    scale.append( DiatonicPitch( p.pitch+offset, p.accs ) )
+                scale = ex.get_scale(clef, accs, direction)
 
             scales.append(scale)
             old_scale = scale[:]
 
         return scales
 
+    @memoize(_answers_key)
     def get_expected_answers(self, lang: str) -> []:
         answers: [str] = []
         for s in self.get_scales():
@@ -363,7 +629,8 @@ class ScaleSubmission(Submission):
 
         return answers
 
-    def get_score_vector(self, lang: str) -> []:
+    @memoize(_score_key)
+    def compute_score_vector(self, lang: str) -> []:
         score_vec = []
         i=0
         for s in self.get_scales():
@@ -377,37 +644,109 @@ class ScaleSubmission(Submission):
 
         return score_vec
 
+# Concrete exercise and submission classes of each exercise type.
+EXERCISE_CLASSES = {
+    ExerciseTypes.NOTE_PITCH: NotePitchExercise,
+    ExerciseTypes.INTERVAL: IntervalExercise,
+    ExerciseTypes.SCALE: ScaleExercise,
+}
+SUBMISSION_CLASSES = {
+    ExerciseTypes.NOTE_PITCH: NotePitchSubmission,
+    ExerciseTypes.INTERVAL: IntervalSubmission,
+    ExerciseTypes.SCALE: ScaleSubmission,
+}
+
+# Arguments of Exercise.objects.select_related() fetching the concrete exercise
+# in the same query. Prefix them with 'token__' for submissions.
+EXERCISE_RELATED = [e_class._meta.model_name for e_class in EXERCISE_CLASSES.values()]
+
 class DiatonicPitch:
+    """Immutable pitch value
+
+    Pitches within INTERNED_PITCHES are created once at import, constructing
+    them again in the generation loops is a dict lookup returning the same
+    instance."""
+    __slots__ = ('pitch', 'accs')
     pitch: int # 0 is sub-contra octave
     accs: int # 1 sharp, -1 flat
 
-    def __init__(self, pitch: int, accs: int):
-        self.pitch = pitch
-        self.accs = accs
+    _interned = {}
+
+    def __new__(cls, pitch: int, accs: int):
+        try:
+            return cls._interned[pitch, accs]
+        except KeyError:
+            pass
+        self = object.__new__(cls)
+        object.__setattr__(self, 'pitch', pitch)
+        object.__setattr__(self, 'accs', accs)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("DiatonicPitch is immutable")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return DiatonicPitch, (self.pitch, self.accs)
 
     def __repr__(self):
         return "({}, {})".format(self.pitch, self.accs)
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if other is None:
             return False
         return self.pitch == other.pitch and self.accs == other.accs
 
+    def __hash__(self):
+        return hash((self.pitch, self.accs))
+
     def __add__(self, i: 'Interval') -> 'DiatonicPitch':
-        dp = DiatonicPitch(self.pitch, self.accs)
+        """transposes pitch by the interval using the lookup tables, equivalent to add_reference()"""
+        pitch, accs = self.pitch, self.accs
+
+        # Only use positive intervals in up direction, see add_reference().
+        if i.quantity < 0:
+            if i.quantity != -1:
+                pitch += math.floor((i.quantity+1)/7)*7
+            else:
+                pitch -= 7
+            i = -i
+
+        pitch += i.quantity - 1
+        q = (i.quantity - 1) % 7
+        deltaAccs = -intervals.DEGREE_OFFSET[self.pitch % 7][q]
+
+        if intervals.PERFECT_QUANTITY[q]:
+            if i.quality < 0:
+                accs += deltaAccs + i.quality + 1
+            elif i.quality > 0:
+                accs = deltaAccs + i.quality - 1 # NB: like the reference, ignores accidentals of the pitch
+            else:
+                accs += deltaAccs
+        elif i.quality != 0:
+            accs += deltaAccs + i.quality - (i.quality > 0)
+
+        return DiatonicPitch(pitch, accs)
+
+    def add_reference(self, i: 'Interval') -> 'DiatonicPitch':
+        """transposes pitch by the interval, reference implementation of __add__()"""
+        pitch, accs = self.pitch, self.accs
 
         # Only use positive intervals in up direction. If interval is negative, inverse it.
         if (i.quantity < 0):
             if (i.quantity != -1):
                 # First lower the pitch for i octaves + 1,
-                dp.pitch += math.floor((i.quantity+1)/7)*7
+                pitch += math.floor((i.quantity+1)/7)*7
             else:
                 # The exception is the negative prime (which is illegal in musical terms, but we still need to handle it).
-                dp.pitch -= 7
+                pitch -= 7
             # Then inverse the interval (NB: negative prime becomes octave). Below, the positive interval is now added to the lowered note.
             i = -i
 
-        dp.pitch += i.quantity - 1
+        pitch += i.quantity - 1
         deltaAccs = 0
         relP = self.pitch % 7
         relQnt = ((i.quantity - 1) % 7) + 1
@@ -447,20 +786,27 @@ class DiatonicPitch:
 
         if relQnt == 4 or relQnt == 5 or relQnt == 1:
             if i.quality < 0:
-                dp.accs += deltaAccs + i.quality + 1
+                accs += deltaAccs + i.quality + 1
             elif i.quality > 0:
-                dp.accs = deltaAccs + i.quality - 1
+                accs = deltaAccs + i.quality - 1
             else:
-                dp.accs += deltaAccs
+                accs += deltaAccs
         else:
             if i.quality < 0:
-                dp.accs += deltaAccs + i.quality
+                accs += deltaAccs + i.quality
             elif i.quality > 0:
-                dp.accs += deltaAccs + i.quality - 1
+                accs += deltaAccs + i.quality - 1
 
-        return dp
+        return DiatonicPitch(pitch, accs)
 
     def to_name(self, lang: str = 'en', relative = False) -> str:
+        """converts pitch to note name, looked up in PITCH_NAMES. See to_name_reference()"""
+        try:
+            return PITCH_NAMES[lang][self, relative]
+        except KeyError:
+            return self.to_name_reference(lang, relative)
+
+    def to_name_reference(self, lang: str = 'en', relative = False) -> str:
         """converts pitch to note name. e.g. (0,0) -> C2, (9, 1) -> Eis1, (28, 0) -> c1
 
         If relative is set, it returns the lower-case note name only without the octave.
@@ -500,6 +846,13 @@ class DiatonicPitch:
         return self.__add__(Interval(i.quality, -i.quantity))
 
     def from_name(name: str, lang: str = 'en') -> 'DiatonicPitch':
+        """converts note name to pitch, looked up in PITCH_VALUES. See from_name_reference()"""
+        try:
+            return PITCH_VALUES[lang][name]
+        except KeyError:
+            return _pitch_from_name(name, lang)
+
+    def from_name_reference(name: str, lang: str = 'en') -> 'DiatonicPitch':
         """converts note name to pitch. Returns None, if pitch is invalid"""
         if not name:
             return None
@@ -550,6 +903,8 @@ class DiatonicPitch:
         return name
 
 class Interval:
+    """Immutable interval value, interned like DiatonicPitch within INTERNED_INTERVALS"""
+    __slots__ = ('quality', 'quantity')
     quality: int # 0 perfect, 1 major, -1 minor, 2 augmented, -2 diminished
     quantity: int # 1 prime, 2 second, 3 third etc. Can be negative, if direction is important
 
@@ -568,24 +923,63 @@ class Interval:
     SEVENTH = 7
     OCTAVE = 8
 
-    def __init__(self, quality: int, quantity: int):
-        self.quality = quality
-        self.quantity = quantity
+    _interned = {}
+
+    def __new__(cls, quality: int, quantity: int):
+        try:
+            return cls._interned[quality, quantity]
+        except KeyError:
+            pass
+        self = object.__new__(cls)
+        object.__setattr__(self, 'quality', quality)
+        object.__setattr__(self, 'quantity', quantity)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Interval is immutable")
+
+    __delattr__ = __setattr__
+
+    def __reduce__(self):
+        return Interval, (self.quality, self.quantity)
 
     def __repr__(self):
         return "({}, {})".format(self.quality, self.quantity)
 
     def __eq__(self, other):
+        if other is self:
+            return True
         if other is None:
             return False
         return self.quantity == other.quantity and self.quality == other.quality
 
+    def __hash__(self):
+        return hash((self.quality, self.quantity))
+
     def __neg__(self):
         """Inverse interval. e.g. Major second -> Minor seventh, Perfect fourth -> perfect fifth"""
         return Interval(-self.quality, 8-(abs(self.quantity)-1) )
 
     @staticmethod
-    def from_diatonic_pitches( pitch_pair: (DiatonicPitch, DiatonicPitch), absolute: bool = True) -> 'Interval':
+    def from_diatonic_pitches(pitch_pair: (DiatonicPitch, DiatonicPitch), absolute: bool = True) -> 'Interval':
+        """construct an interval between given pitches using the lookup tables
+
+        Equivalent to from_diatonic_pitches_reference(), see there for the parameters."""
+        pitch1, pitch2 = pitch_pair
+        swapped = pitch1.pitch > pitch2.pitch or (pitch1.pitch == pitch2.pitch and pitch1.accs > pitch2.accs)
+        pLow, pHigh = (pitch2, pitch1) if swapped else (pitch1, pitch2)
+
+        quantity = pHigh.pitch - pLow.pitch + 1
+        q = (quantity - 1) % 7
+        quality = intervals.quality(intervals.DEGREE_OFFSET[pLow.pitch % 7][q] + pHigh.accs - pLow.accs, q)
+
+        if not absolute and swapped:
+            quantity *= -1
+
+        return Interval(quality, quantity)
+
+    @staticmethod
+    def from_diatonic_pitches_reference( pitch_pair: (DiatonicPitch, DiatonicPitch), absolute: bool = True) -> 'Interval':
         """
         Construct an interval between given pitches.
 
@@ -598,7 +992,6 @@ class Interval:
         """
         pitch1 = pitch_pair[0]
         pitch2 = pitch_pair[1]
-        interval = Interval(0, 0)
         pLow: DiatonicPitch
         pHigh: DiatonicPitch
         if pitch1.pitch < pitch2.pitch or (pitch1.pitch == pitch2.pitch and pitch1.accs <= pitch2.accs):
@@ -608,8 +1001,8 @@ class Interval:
             pLow = pitch2
             pHigh = pitch1
 
-        interval.quantity = pHigh.pitch - pLow.pitch + 1
-        relQnt = ((interval.quantity - 1) % 7) + 1
+        quantity = pHigh.pitch - pLow.pitch + 1
+        relQnt = ((quantity - 1) % 7) + 1
         relPLow = (pLow.pitch % 7)
         deltaQlt = 0
         # TODO: Rewrite using match statement introduced in Python 3.10
@@ -649,28 +1042,33 @@ class Interval:
         if relQnt == Interval.PRIME or relQnt == Interval.FOURTH or relQnt == Interval.FIFTH:
             # prime, fourth, fifth are perfect, diminished or augmented
             if (deltaQlt == 2 and pHigh.accs - pLow.accs == -1) or (deltaQlt == 0 and pHigh.accs - pLow.accs <= -1):
-                interval.quality = deltaQlt + pHigh.accs - pLow.accs - 1
+                quality = deltaQlt + pHigh.accs - pLow.accs - 1
             elif deltaQlt == 2 and pHigh.accs - pLow.accs < -1:
-                interval.quality = deltaQlt + pHigh.accs - pLow.accs - 2
+                quality = deltaQlt + pHigh.accs - pLow.accs - 2
             elif (deltaQlt == -2 and pHigh.accs - pLow.accs == 1) or (deltaQlt == 0 and pHigh.accs - pLow.accs >= 1):
-                interval.quality = deltaQlt + pHigh.accs - pLow.accs + 1
+                quality = deltaQlt + pHigh.accs - pLow.accs + 1
             elif deltaQlt == -2 and pHigh.accs - pLow.accs > 1:
-                interval.quality = deltaQlt + pHigh.accs - pLow.accs + 2
+                quality = deltaQlt + pHigh.accs - pLow.accs + 2
             else:
-                interval.quality = deltaQlt + pHigh.accs - pLow.accs
+                quality = deltaQlt + pHigh.accs - pLow.accs
         elif deltaQlt == Interval.MAJOR and pHigh.accs - pLow.accs < 0: # second, third, sixth and seventh cannot be perfect
-            interval.quality = deltaQlt + pHigh.accs - pLow.accs - 1
+            quality = deltaQlt + pHigh.accs - pLow.accs - 1
         elif deltaQlt == Interval.MINOR and pHigh.accs - pLow.accs > 0:
-            interval.quality = deltaQlt + pHigh.accs - pLow.accs + 1
+            quality = deltaQlt + pHigh.accs - pLow.accs + 1
         else:
-            interval.quality = deltaQlt + pHigh.accs - pLow.accs
+            quality = deltaQlt + pHigh.accs - pLow.accs
 
         if not absolute and (pitch1.pitch > pitch2.pitch or (pitch1.pitch == pitch2.pitch and pitch1.accs > pitch2.accs)):
-            interval.quantity *= -1
+            quantity *= -1
 
-        return interval
+        return Interval(quality, quantity)
 
     def semitones(self) -> int:
+        """return the number of semitones in the interval using the lookup tables, equivalent to semitones_reference()"""
+        q = (abs(self.quantity) - 1) % 7
+        return abs(intervals.BASE_SEMITONES[q] + intervals.quality_semitones(self.quality, q) + 12 * ((abs(self.quantity) - 1) // 7))
+
+    def semitones_reference(self) -> int:
         """
         Return the number of semitones in the interval.
 
@@ -719,6 +1117,13 @@ class Interval:
         return abs(semitones)
 
     def to_name(self, lang: str = 'en') -> str:
+        """converts interval to human readable, looked up in INTERVAL_NAMES. See to_name_reference()"""
+        try:
+            return INTERVAL_NAMES[lang][self]
+        except KeyError:
+            return self.to_name_reference(lang)
+
+    def to_name_reference(self, lang: str = 'en') -> str:
         """converts interval to human readable. e.g. (2, 4) -> aug4, (0, 5) -> p5, (1, 2) -> maj2, (-1, 2) -> min2, (-1, -2) -> -min2"""
         quality_name: str
         if lang=='sl':
@@ -753,6 +1158,13 @@ class Interval:
         return name
 
     def from_name(name: str, lang: str) -> 'Interval':
+        """converts human-readable interval to interval, looked up in INTERVAL_VALUES. See from_name_reference()"""
+        try:
+            return INTERVAL_VALUES[lang][name]
+        except KeyError:
+            return _interval_from_name(name, lang)
+
+    def from_name_reference(name: str, lang: str) -> 'Interval':
         """converts human-readable interval to interval. Returns None, if interval is invalid"""
         if not name:
             return None
@@ -787,6 +1199,40 @@ class Interval:
 
         return Interval(quality, quantity)
 
+# Values created once and shared by all DiatonicPitch(pitch, accs) and
+# Interval(quality, quantity) calls: all pitches from the lowest to the highest
+# octave used by the exercises with up to triple accidentals and intervals up to
+# three octaves.
+INTERNED_PITCHES = [(pitch, accs) for pitch in range(0, 70) for accs in range(-3, 4)]
+INTERNED_INTERVALS = [(quality, quantity) for quality in range(-4, 5) for quantity in range(-22, 23)]
+DiatonicPitch._interned.update((values, DiatonicPitch(*values)) for values in INTERNED_PITCHES)
+Interval._interned.update((values, Interval(*values)) for values in INTERNED_INTERVALS)
+
+# Names of the interned pitches and intervals in each language and the values
+# of these names, all computed once by the reference implementations. Names are
+# parsed in every language, e.g. PITCH_VALUES['sl']['bes1'] is there too. Other
+# names, e.g. typos in the answers, are parsed by the memoized references.
+NAME_LANGUAGES = ['en', 'sl', 'de']
+PITCH_NAMES = {
+    lang: {(p, relative): p.to_name_reference(lang, relative)
+           for p in DiatonicPitch._interned.values() for relative in [False, True]}
+    for lang in NAME_LANGUAGES
+}
+PITCH_VALUES = {
+    lang: {name: DiatonicPitch.from_name_reference(name, lang) for names in PITCH_NAMES.values() for name in names.values()}
+    for lang in NAME_LANGUAGES
+}
+INTERVAL_NAMES = {
+    lang: {i: i.to_name_reference(lang) for i in Interval._interned.values()}
+    for lang in NAME_LANGUAGES
+}
+INTERVAL_VALUES = {
+    lang: {name: Interval.from_name_reference(name, lang) for names in INTERVAL_NAMES.values() for name in names.values()}
+    for lang in NAME_LANGUAGES
+}
+_pitch_from_name = functools.lru_cache(maxsize=4096)(DiatonicPitch.from_name_reference)
+_interval_from_name = functools.lru_cache(maxsize=4096)(Interval.from_name_reference)
+
 class Scale:
     """Diatonic major/minor scale"""
 
@@ -817,6 +1263,14 @@ class Scale:
         return "({}, {}, {})".format(self.gender, self.shape, self.accs)
 
     def get_pitches(self) -> []:
+        """return pitches of the scale from the lowest octave, looked up in SCALES. See get_pitches_reference()"""
+        try:
+            return list(SCALES[self.gender, self.shape, self.accs])
+        except KeyError:
+            return self.get_pitches_reference()
+
+    def get_pitches_reference(self) -> []:
+        """return pitches of the scale from the lowest octave, built by stacking fifths and seconds"""
         init_pitch = DiatonicPitch(0,0)
         for i in range(0, self.accs):
             init_pitch += Interval(Interval.PERFECT, Interval.FIFTH)
@@ -826,7 +1280,7 @@ class Scale:
         if self.gender==ScaleGender.MINOR:
             init_pitch -= Interval(Interval.MINOR, Interval.THIRD)
 
-        init_pitch.pitch %= 7
+        init_pitch = DiatonicPitch(init_pitch.pitch % 7, init_pitch.accs)
         if init_pitch.pitch < 0:
             init_pitch += 7
 
@@ -835,3 +1289,10 @@ class Scale:
             pitches.append(pitches[-1] + Interval(Scale.interval_matrix[(self.gender, self.shape)][i], Interval.SECOND))
 
         return pitches
+
+# Pitches of all scales with up to 7 sharps or flats by (gender, shape, accs).
+SCALE_KEY_SIGNATURES = range(-7, 8)
+SCALES = {
+    (gender, shape, accs): tuple(Scale(gender, shape, accs).get_pitches_reference())
+    for gender in ScaleGender for shape in ScaleShape for accs in SCALE_KEY_SIGNATURES
+}
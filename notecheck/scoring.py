@@ -0,0 +1,56 @@
+"""Scoring of many submissions at once, e.g. after the scoring rules changed"""
+import time
+from datetime import timedelta
+
+from django.db.models import QuerySet
+
+from .models import EXERCISE_RELATED, Exercise, Submission
+
+SCORE_FIELDS = ['score', 'max_score', 'score_vector', 'perfect']
+
+# Submissions loaded, scored and written back at once.
+CHUNK_SIZE = 500
+
+def finalized_submissions(exercise: Exercise = None, missing: bool = True) -> QuerySet:
+    """return finalized submissions of the exercise or all exercises, only the ones without stored score if missing is set"""
+    submissions = Submission.objects.filter(duration__gt=timedelta(0))
+    if exercise is not None:
+        submissions = submissions.filter(token=exercise)
+    if missing:
+        submissions = submissions.filter(score_vector__isnull=True)
+    return submissions
+
+def _score_chunk(chunk: [Submission], exercises: {}):
+    """stores scores of the submissions, sharing a single instance of each exercise"""
+    missing = {s.token_id for s in chunk} - exercises.keys()
+    if missing:
+        for token, ex in Exercise.objects.select_related(*EXERCISE_RELATED).in_bulk(missing).items():
+            exercises[token] = ex.get_instance()
+
+    for s in chunk:
+        # The exercise memoizes its candidate questions, which are then
+        # generated once for all submissions of the exercise.
+        s.token = exercises[s.token_id]
+        s.store_score()
+    Submission.objects.bulk_update(chunk, SCORE_FIELDS)
+
+def rescore(submissions: QuerySet, chunk_size: int = CHUNK_SIZE) -> (int, float):
+    """stores scores of the submissions, returns the number of submissions and the seconds spent
+
+    Submissions are streamed in chunks, each exercise is loaded once and the
+    scores are written back with a single query per chunk."""
+    start = time.monotonic()
+    exercises = {}
+    count = 0
+    chunk = []
+    for s in submissions.order_by('pk').iterator(chunk_size=chunk_size):
+        chunk.append(s)
+        if len(chunk) == chunk_size:
+            _score_chunk(chunk, exercises)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        _score_chunk(chunk, exercises)
+        count += len(chunk)
+
+    return count, time.monotonic() - start
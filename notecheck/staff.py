@@ -0,0 +1,141 @@
+"""Pure python svg engine for the question snippets: a single staff with a clef and whole notes.
+
+Coordinates are in staff spaces with y pointing down and the top staff line at y=0."""
+import math
+
+VERSION = 1 # bump when the output changes to invalidate cached svgs
+
+STAFF_SPACE = 1.5 # mm, corresponds to lilypond's global staff size 17
+LINE_THICKNESS = 0.1
+CLEF_WIDTH = 4.0
+COLUMN_WIDTH = 4.0 # horizontal space of a whole note or a skip
+NOTEHEAD_WIDTH = 1.64
+LEDGER_OVERHANG = 0.35
+ACCIDENTAL_GAP = 0.2
+
+# Pitch on the bottom staff line.
+BOTTOM_LINE_PITCH = {
+    'treble': 30, # e1
+    'bass': 18, # G
+}
+
+def _n(x: float) -> str:
+    """formats a coordinate"""
+    return format(round(x, 3), 'g')
+
+def _ellipse(rx: float, ry: float, angle: float = 0) -> str:
+    """returns closed path of an ellipse centered at the origin and rotated by angle degrees"""
+    x = rx*math.cos(math.radians(angle))
+    y = rx*math.sin(math.radians(angle))
+    return "M{x0} {y0}A{rx} {ry} {a} 1 0 {x1} {y1}A{rx} {ry} {a} 1 0 {x0} {y0}Z".format(
+        x0=_n(x), y0=_n(y), x1=_n(-x), y1=_n(-y), rx=_n(rx), ry=_n(ry), a=_n(angle))
+
+def _circle(cx: float, cy: float, r: float) -> str:
+    return "M{x0} {y}A{r} {r} 0 1 0 {x1} {y}A{r} {r} 0 1 0 {x0} {y}Z".format(
+        x0=_n(cx-r), x1=_n(cx+r), y=_n(cy), r=_n(r))
+
+def _rect(x: float, y: float, width: float, height: float) -> str:
+    return "M{x} {y}h{w}v{h}h{mw}Z".format(x=_n(x), y=_n(y), w=_n(width), h=_n(height), mw=_n(-width))
+
+def _bar(x1: float, y1: float, x2: float, y2: float, thickness: float) -> str:
+    """returns closed path of a thick line segment"""
+    length = math.hypot(x2-x1, y2-y1)
+    dx = (y2-y1)/length*thickness/2
+    dy = -(x2-x1)/length*thickness/2
+    return "M{} {}L{} {}L{} {}L{} {}Z".format(
+        _n(x1+dx), _n(y1+dy), _n(x2+dx), _n(y2+dy), _n(x2-dx), _n(y2-dy), _n(x1-dx), _n(y1-dy))
+
+# Glyphs are (path, width, fill rule) with the origin at their left edge on the note's line.
+NOTEHEAD = (_ellipse(NOTEHEAD_WIDTH/2, 0.56) + _ellipse(0.42, 0.28, -45), NOTEHEAD_WIDTH, 'evenodd')
+SHARP = (
+    _rect(0.24, -1.3, 0.12, 2.8) + _rect(0.64, -1.5, 0.12, 2.8) +
+    "M0 -0.2L1 -0.42L1 -0.64L0 -0.42ZM0 0.64L1 0.42L1 0.2L0 0.42Z",
+    1.0, 'nonzero'
+)
+FLAT = (
+    _rect(0, -1.9, 0.12, 2.45) +
+    "M0.12 -0.15C0.5 -0.65 1.02 -0.55 0.94 -0.15C0.86 0.2 0.46 0.4 0.12 0.55Z"
+    "M0.2 0.05C0.45 -0.35 0.74 -0.36 0.72 -0.1C0.68 0.15 0.44 0.3 0.2 0.4Z",
+    0.95, 'evenodd'
+)
+DOUBLE_SHARP = (
+    _bar(0.1, -0.4, 0.9, 0.4, 0.14) + _bar(0.1, 0.4, 0.9, -0.4, 0.14) +
+    _rect(0, -0.5, 0.3, 0.3) + _rect(0.7, -0.5, 0.3, 0.3) + _rect(0, 0.2, 0.3, 0.3) + _rect(0.7, 0.2, 0.3, 0.3),
+    1.0, 'nonzero'
+)
+
+# Clefs are stroked paths plus filled dots with the origin at the top staff line.
+TREBLE_CLEF = (
+    "M1.35 3.45C0.85 3.55 0.75 2.75 1.3 2.6C2.1 2.45 2.3 3.6 1.45 3.85C0.3 4.1 0 2.9 0.6 2.1"
+    "C1.1 1.4 1.9 0.8 1.9 -0.4C1.9 -1.5 1.3 -1.9 1.1 -0.9C0.9 0.2 1.4 3.5 1.55 5C1.65 5.9 0.9 6.2 0.6 5.6",
+    _circle(0.8, 5.45, 0.3),
+)
+BASS_CLEF = (
+    "M0.3 1C0.3 -0.1 2.3 -0.3 2.3 1.3C2.3 2.8 1.2 3.9 0.1 4.4",
+    _circle(0.45, 1.05, 0.35) + _circle(2.85, 0.5, 0.16) + _circle(2.85, 1.5, 0.16),
+)
+CLEFS = {
+    'treble': TREBLE_CLEF,
+    'bass': BASS_CLEF,
+}
+
+def _accidentals(accs: int) -> []:
+    """returns glyphs of the accidentals from left to right. Double flat is drawn as two flats."""
+    if accs > 0:
+        return [SHARP]*(accs % 2) + [DOUBLE_SHARP]*(accs // 2)
+    return [FLAT]*-accs
+
+def _path(glyph: (), x: float, y: float) -> str:
+    return '<path transform="translate({x},{y})" fill-rule="{rule}" d="{d}"/>'.format(
+        x=_n(x), y=_n(y), rule=glyph[2], d=glyph[0])
+
+def render_svg(clef: str, pitches: ['DiatonicPitch'], skip: int = 0) -> str:
+    """returns svg of a staff with the given clef and whole notes
+
+    Each note takes one column of the staff, skip empty columns are inserted
+    after the first note."""
+    bottom_line_pitch = BOTTOM_LINE_PITCH[clef]
+    columns = [0] + [1+skip+i for i in range(len(pitches)-1)]
+    width = CLEF_WIDTH + (columns[-1]+1)*COLUMN_WIDTH
+    if len(pitches) == 1:
+        width += 0.5 # final bar line
+
+    elements = []
+    for i in range(5):
+        elements.append('<path d="{}"/>'.format(_rect(0, i-LINE_THICKNESS/2, width, LINE_THICKNESS)))
+    if len(pitches) == 1:
+        elements.append('<path d="{}"/>'.format(_rect(width-0.16, -LINE_THICKNESS/2, 0.16, 4+LINE_THICKNESS)))
+
+    stroke, dots = CLEFS[clef]
+    elements.append('<path transform="translate(0.6,0)" fill="none" stroke="currentColor" stroke-width="0.2" d="{}"/>'.format(stroke))
+    elements.append('<path transform="translate(0.6,0)" d="{}"/>'.format(dots))
+
+    ys = []
+    for p, column in zip(pitches, columns):
+        y = 4 - (p.pitch-bottom_line_pitch)/2
+        ys.append(y)
+        x = CLEF_WIDTH + (column+0.6)*COLUMN_WIDTH - NOTEHEAD_WIDTH/2
+
+        # Ledger lines above and below the staff.
+        ledger = _rect(-LEDGER_OVERHANG, -LINE_THICKNESS/2, NOTEHEAD_WIDTH+2*LEDGER_OVERHANG, LINE_THICKNESS)
+        ledger_ys = list(range(-1, math.ceil(y)-1, -1)) + list(range(5, math.floor(y)+1))
+        for ly in ledger_ys:
+            elements.append('<path transform="translate({},{})" d="{}"/>'.format(_n(x), _n(ly), ledger))
+
+        elements.append(_path(NOTEHEAD, x+NOTEHEAD_WIDTH/2, y))
+
+        acc_x = x
+        for glyph in reversed(_accidentals(p.accs)):
+            acc_x -= glyph[1] + ACCIDENTAL_GAP
+            elements.append(_path(glyph, acc_x, y))
+
+    top = min([-2.4] + [y-2.4 for y in ys])
+    bottom = max([6.6] + [y+1.0 for y in ys])
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" version="1.2" width="{w}mm" height="{h}mm" viewBox="-0.2 {top} {vw} {vh}">'
+        '<g fill="currentColor">{elements}</g></svg>\n'
+    ).format(
+        w=_n((width+0.4)*STAFF_SPACE), h=_n((bottom-top)*STAFF_SPACE),
+        top=_n(top), vw=_n(width+0.4), vh=_n(bottom-top),
+        elements=''.join(elements)
+    )
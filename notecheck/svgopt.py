@@ -0,0 +1,70 @@
+"""Post-processing of rendered svgs"""
+import re
+
+PATH_RE = re.compile(r'<path\b([^>]*?)\sd="([^"]*)"([^>]*?)\s*(?:/>|></path>)')
+
+# Shorter paths are cheaper to repeat than to reference.
+MIN_SHARED_PATH_LENGTH = 40
+
+def share_glyphs(svgs: [str]) -> (str, [str]):
+    """moves paths repeated among the inlined svgs of a page into shared definitions
+
+    Returns the svg holding the <defs> block, which needs to be included in the
+    page once, and the svgs with repeated paths replaced by <use> references."""
+    counts = {}
+    for svg in svgs:
+        for m in PATH_RE.finditer(svg):
+            counts[m.group(2)] = counts.get(m.group(2), 0) + 1
+
+    ids = {}
+    for d, count in counts.items():
+        if count > 1 and len(d) >= MIN_SHARED_PATH_LENGTH:
+            ids[d] = 'nc-g{}'.format(len(ids))
+
+    if not ids:
+        return '', svgs
+
+    def use(m: re.Match) -> str:
+        if m.group(2) not in ids:
+            return m.group(0)
+        return '<use href="#{}"{}{}/>'.format(ids[m.group(2)], m.group(1), m.group(3))
+
+    defs = '<svg width="0" height="0" style="position:absolute" aria-hidden="true"><defs>{}</defs></svg>'.format(
+        ''.join('<path id="{}" d="{}"/>'.format(id, d) for d, id in ids.items())
+    )
+    return defs, [PATH_RE.sub(use, svg) for svg in svgs]
+
+ATTRIBUTE_RE = re.compile(r'(\s[\w:-]+)="([^"]*)"')
+GEOMETRY_ATTRIBUTES = {
+    'd', 'transform', 'viewBox', 'points', 'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry',
+    'width', 'height', 'stroke-width', 'font-size',
+}
+NUMBER_RE = re.compile(r'-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+METADATA_RE = re.compile(r'<\?xml[^>]*\?>|<!--.*?-->|<(title|desc|metadata)\b[^>]*>.*?</\1>', re.DOTALL)
+
+def _round(m: re.Match) -> str:
+    """rounds number to 3 decimals or 3 significant digits for small numbers, e.g. glyph scale factors"""
+    x = float(m.group(0))
+    if abs(x) >= 0.1:
+        x = round(x, 3)
+    else:
+        x = float('{:.3g}'.format(x))
+
+    s = repr(x)
+    if s.endswith('.0'):
+        s = s[:-2]
+    if s == '-0':
+        s = '0'
+    return s
+
+def _minify_attribute(m: re.Match) -> str:
+    value = ' '.join(m.group(2).split())
+    if m.group(1).strip() in GEOMETRY_ATTRIBUTES:
+        value = NUMBER_RE.sub(_round, value)
+    return '{}="{}"'.format(m.group(1), value)
+
+def minify(svg: str) -> str:
+    """strips xml declaration, comments and metadata, rounds coordinates and collapses whitespace"""
+    svg = METADATA_RE.sub('', svg)
+    svg = re.sub(r'>\s+<', '><', svg.strip())
+    return re.sub(r'<[^>]+>', lambda tag: ATTRIBUTE_RE.sub(_minify_attribute, ' '.join(tag.group(0).split())), svg) + '\n'
@@ -1,6 +1,17 @@
-from django.test import TestCase
+import asyncio, copy, gzip, io, json, os, pickle, re, shutil, sys, tempfile, threading, time
+from unittest import mock, skipIf
 
-from .models import DiatonicPitch, Interval, Scale, ScaleGender, ScaleShape
+from asgiref.sync import async_to_sync
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import cachedir, intervals, lilypond, lilyworker, scoring, staff, views
+from .lilypond import MemoryCache
+from .management.commands.prerender_exercise import get_exercise_snippets
+from .models import *
+from .svgopt import minify, share_glyphs
 
 class DiatonicPitchTests(TestCase):
     def test_add(self):
@@ -110,6 +121,37 @@ class DiatonicPitchTests(TestCase):
         self.assertEquals(DiatonicPitch(28,-1).to_lilypond(), "ces'")
         self.assertEquals(DiatonicPitch(36,0).to_lilypond(), "d''")
 
+    # Answers are parsed leniently, these are not the names returned by to_name().
+    LENIENT_NAMES = ['', 'C', 'cs', 'CIS1', 'ces', 'Es', 'ees', 'aes', 'as2', 'b', 'bb1', 'Bes', 'hes', 'x', 'c9', 'c10', 'ciss', 'fisis4', 'h5']
+
+    def test_names(self):
+        for lang in ['en', 'sl', 'de', 'fr']:
+            for p in list(DiatonicPitch._interned.values()) + [DiatonicPitch(100, 0), DiatonicPitch(30, 5)]:
+                for relative in [False, True]:
+                    name = p.to_name(lang, relative)
+                    self.assertEqual(name, p.to_name_reference(lang, relative))
+                    self.assertEqual(DiatonicPitch.from_name(name, lang), DiatonicPitch.from_name_reference(name, lang), (name, lang))
+            for name in self.LENIENT_NAMES:
+                self.assertEqual(DiatonicPitch.from_name(name, lang), DiatonicPitch.from_name_reference(name, lang), (name, lang))
+
+    def test_value(self):
+        p = DiatonicPitch(30, 1)
+        self.assertIs(DiatonicPitch(30, 1), p)
+        self.assertIs(DiatonicPitch(pitch=30, accs=1), p)
+        self.assertIs(DiatonicPitch(29, 1) + Interval(Interval.MAJOR, Interval.SECOND), p)
+        self.assertIs(pickle.loads(pickle.dumps(p)), p)
+        self.assertIs(copy.deepcopy(p), p)
+        with self.assertRaises(AttributeError):
+            p.pitch = 31
+        with self.assertRaises(AttributeError):
+            p.octave = 4
+        self.assertEqual({p: 'e1'}[DiatonicPitch(30, 1)], 'e1')
+
+        # Outside of the interned pitches the values are still equal and hashable.
+        self.assertIsNot(DiatonicPitch(100, 9), DiatonicPitch(100, 9))
+        self.assertEqual(DiatonicPitch(100, 9), DiatonicPitch(100, 9))
+        self.assertEqual(len({DiatonicPitch(100, 9), DiatonicPitch(100, 9), p}), 2)
+
 class IntervalTests(TestCase):
     def test_from_diatonic_pitches_absolute_no_accs(self):
         self.assertEquals(Interval.from_diatonic_pitches((DiatonicPitch(0,0), DiatonicPitch(1,0)), True), Interval(Interval.MAJOR, Interval.SECOND))
@@ -240,7 +282,991 @@ class IntervalTests(TestCase):
         self.assertEquals(Interval.from_name('-zm5', lang='sl'), Interval(Interval.DIMINISHED, -Interval.FIFTH))
         self.assertEquals(Interval.from_name('-zmzm5', lang='sl'), Interval(Interval.DIMINISHED-1, -Interval.FIFTH))
 
+    # Whole range of pitches and accidentals used by the exercises and then some.
+    ALL_PITCHES = [DiatonicPitch(p, accs) for p in range(0, 56) for accs in range(-3, 4)]
+    ALL_INTERVALS = [Interval(quality, quantity) for quality in range(-4, 5) for quantity in range(-22, 23) if quantity != 0]
+
+    def test_from_diatonic_pitches_reference(self):
+        for p1 in self.ALL_PITCHES:
+            for p2 in self.ALL_PITCHES:
+                for absolute in [True, False]:
+                    self.assertEqual(
+                        Interval.from_diatonic_pitches((p1, p2), absolute),
+                        Interval.from_diatonic_pitches_reference((p1, p2), absolute),
+                        (p1, p2, absolute),
+                    )
+
+    def test_semitones_reference(self):
+        for i in self.ALL_INTERVALS:
+            self.assertEqual(i.semitones(), i.semitones_reference(), i)
+
+    def test_add_reference(self):
+        for p in self.ALL_PITCHES:
+            for i in self.ALL_INTERVALS:
+                self.assertEqual(p + i, p.add_reference(i), (p, i))
+
+    @skipIf(intervals.numpy is None, 'numpy is not installed')
+    def test_batch_intervals(self):
+        pairs = [(p1, p2) for p1 in self.ALL_PITCHES[::3] for p2 in self.ALL_PITCHES]
+        for absolute in [True, False]:
+            quantities, qualities, semitones = intervals.intervals(
+                [p1.pitch for p1, p2 in pairs], [p1.accs for p1, p2 in pairs],
+                [p2.pitch for p1, p2 in pairs], [p2.accs for p1, p2 in pairs],
+                absolute,
+            )
+            for pair, quantity, quality, st in zip(pairs, quantities.tolist(), qualities.tolist(), semitones.tolist()):
+                expected = Interval.from_diatonic_pitches_reference(pair, absolute)
+                self.assertEqual((quantity, quality, st), (expected.quantity, expected.quality, expected.semitones_reference()), pair)
+
+    @skipIf(intervals.numpy is None, 'numpy is not installed')
+    def test_batch_candidate_pitch_pairs(self):
+        for direction, max_quantity in [(0, 8), (-1, 5), (1, 0)]:
+            ex = IntervalExercise(title='Intervals', direction=direction, max_quantity=max_quantity, max_sharps=2, max_flats=2)
+            candidates = ex.get_candidate_pitch_pairs(Clefs.BASS)
+            with mock.patch.object(intervals, 'numpy', None):
+                self.assertEqual(candidates, ex.get_candidate_pitch_pairs(Clefs.BASS))
+
+    def test_names(self):
+        lenient_names = ['', '-', 'p', 'maj', 'major3', 'mx2', 'vv2', 'augdim4', 'zvaug5', '-dimzm5', 'p15', '-č8', 'p1x', 'č12']
+        for lang in ['en', 'sl', 'de', 'fr']:
+            for i in list(Interval._interned.values()) + [Interval(5, 3), Interval(0, 30)]:
+                name = i.to_name(lang)
+                self.assertEqual(name, i.to_name_reference(lang))
+                self.assertEqual(Interval.from_name(name, lang), Interval.from_name_reference(name, lang), (name, lang))
+            for name in lenient_names:
+                self.assertEqual(Interval.from_name(name, lang), Interval.from_name_reference(name, lang), (name, lang))
+
+    def test_value(self):
+        i = Interval(Interval.MINOR, -Interval.THIRD)
+        self.assertIs(Interval(Interval.MINOR, -Interval.THIRD), i)
+        self.assertIs(-Interval(Interval.MAJOR, Interval.SIXTH), Interval(Interval.MINOR, Interval.THIRD))
+        self.assertIs(pickle.loads(pickle.dumps(i)), i)
+        with self.assertRaises(AttributeError):
+            i.quantity *= -1
+        self.assertEqual(len({i, Interval(Interval.MINOR, -Interval.THIRD), Interval(Interval.MINOR, Interval.THIRD)}), 2)
+
 class ScaleTests(TestCase):
     def test_scales(self):
         self.assertEquals(Scale(ScaleGender.MAJOR, ScaleShape.NATURAL, 0).get_pitches(), [ DiatonicPitch(0,0), DiatonicPitch(1,0), DiatonicPitch(2,0), DiatonicPitch(3,0), DiatonicPitch(4,0), DiatonicPitch(5,0), DiatonicPitch(6,0), DiatonicPitch(7,0)])
-        self.assertEquals(Scale(ScaleGender.MINOR, ScaleShape.NATURAL, -1).get_pitches(), [ DiatonicPitch(1,0), DiatonicPitch(2,0), DiatonicPitch(3,0), DiatonicPitch(4,0), DiatonicPitch(5,0), DiatonicPitch(6,-1), DiatonicPitch(7,0), DiatonicPitch(8,0)])
\ No newline at end of file
+        self.assertEquals(Scale(ScaleGender.MINOR, ScaleShape.NATURAL, -1).get_pitches(), [ DiatonicPitch(1,0), DiatonicPitch(2,0), DiatonicPitch(3,0), DiatonicPitch(4,0), DiatonicPitch(5,0), DiatonicPitch(6,-1), DiatonicPitch(7,0), DiatonicPitch(8,0)])
+
+    def test_scales_reference(self):
+        self.assertEqual(len(SCALES), 2*3*15)
+        for gender in ScaleGender:
+            for shape in ScaleShape:
+                for accs in range(-9, 10):
+                    scale = Scale(gender.value, shape.value, accs)
+                    self.assertEqual(scale.get_pitches(), scale.get_pitches_reference(), scale)
+
+        # Callers get their own list.
+        pitches = Scale(ScaleGender.MAJOR, ScaleShape.NATURAL, 0).get_pitches()
+        pitches.reverse()
+        self.assertEqual(Scale(ScaleGender.MAJOR, ScaleShape.NATURAL, 0).get_pitches()[0], DiatonicPitch(0,0))
+
+class SnippetTests(TestCase):
+    def test_to_lilypond(self):
+        self.assertEqual(lilypond.note_snippet(Clefs.TREBLE, DiatonicPitch(30, 1)).lilysrc,
+                         "{ \\omit Score.TimeSignature \\clef treble eis'1 }")
+        self.assertEqual(lilypond.interval_snippet(Clefs.BASS, DiatonicPitch(30, 1), DiatonicPitch(20, -1)).lilysrc,
+                         "{ \\omit Score.TimeSignature \\clef bass eis'1 \\omit Score.BarLine bes,1 }")
+        self.assertEqual(lilypond.scale_snippet(Clefs.TREBLE, DiatonicPitch(30, 1), DiatonicPitch(37, 1)).lilysrc,
+                         "{ \\omit Score.TimeSignature \\clef treble eis'1 \\omit Score.BarLine " + "s1 "*14 + "eis''1 }")
+
+class StaffTests(TestCase):
+    def glyphs(self, svg: str, glyph: ()) -> [(float, float)]:
+        """returns positions of the glyph in the svg"""
+        pattern = r'<path transform="translate\(([-0-9.]+),([-0-9.]+)\)" fill-rule="{}" d="{}"/>'.format(glyph[2], re.escape(glyph[0]))
+        return [(float(x), float(y)) for x, y in re.findall(pattern, svg)]
+
+    def ledger_lines(self, svg: str) -> [float]:
+        """returns y of the ledger lines in the svg"""
+        ledger = staff._rect(-staff.LEDGER_OVERHANG, -staff.LINE_THICKNESS/2, staff.NOTEHEAD_WIDTH+2*staff.LEDGER_OVERHANG, staff.LINE_THICKNESS)
+        return [float(y) for y in re.findall(r'<path transform="translate\([-0-9.]+,([-0-9.]+)\)" d="{}"/>'.format(re.escape(ledger)), svg)]
+
+    def test_ledger_lines(self):
+        for clef, pitch, lines in [
+            ('treble', 30, []), # e1 on the bottom line
+            ('treble', 38, []), # f2 on the top line
+            ('treble', 28, [5]), # c1
+            ('treble', 22, [5, 6, 7, 8]),
+            ('treble', 23, [5, 6, 7]),
+            ('treble', 40, [-1]), # a2
+            ('treble', 44, [-3, -2, -1]),
+            ('bass', 16, [5]), # E
+            ('bass', 28, [-1]), # c1
+        ]:
+            svg = staff.render_svg(clef, [DiatonicPitch(pitch, 0)])
+            self.assertEqual(sorted(self.ledger_lines(svg)), lines, (clef, pitch))
+
+    def test_noteheads(self):
+        svg = staff.render_svg('treble', [DiatonicPitch(30, 0), DiatonicPitch(31, 0), DiatonicPitch(37, 0)], skip=1)
+        noteheads = self.glyphs(svg, staff.NOTEHEAD)
+        self.assertEqual([y for x, y in noteheads], [4, 3.5, 0.5])
+        xs = [x for x, y in noteheads]
+        self.assertEqual(xs, sorted(xs))
+        self.assertAlmostEqual(xs[1]-xs[0], 2*staff.COLUMN_WIDTH) # skipped column
+        self.assertAlmostEqual(xs[2]-xs[1], staff.COLUMN_WIDTH)
+
+        self.assertEqual(self.glyphs(staff.render_svg('bass', [DiatonicPitch(18, 0)]), staff.NOTEHEAD)[0][1], 4)
+        self.assertEqual(self.glyphs(staff.render_svg('bass', [DiatonicPitch(26, 0)]), staff.NOTEHEAD)[0][1], 0)
+
+    def test_accidentals(self):
+        for accs, sharps, flats, double_sharps in [(0, 0, 0, 0), (1, 1, 0, 0), (-1, 0, 1, 0), (2, 0, 0, 1), (-2, 0, 2, 0)]:
+            svg = staff.render_svg('treble', [DiatonicPitch(34, accs)])
+            self.assertEqual(len(self.glyphs(svg, staff.SHARP)), sharps, accs)
+            self.assertEqual(len(self.glyphs(svg, staff.FLAT)), flats, accs)
+            self.assertEqual(len(self.glyphs(svg, staff.DOUBLE_SHARP)), double_sharps, accs)
+
+            notehead_x, notehead_y = self.glyphs(svg, staff.NOTEHEAD)[0]
+            for glyph in [staff.SHARP, staff.FLAT, staff.DOUBLE_SHARP]:
+                for x, y in self.glyphs(svg, glyph):
+                    # Left of the notehead on the note's line.
+                    self.assertLess(x, notehead_x - staff.NOTEHEAD_WIDTH/2)
+                    self.assertEqual(y, notehead_y)
+
+    def test_size(self):
+        svg = staff.render_svg('treble', [DiatonicPitch(30, 0)])
+        # clef, a column and the final bar line plus margins
+        self.assertIn('width="13.35mm" height="13.5mm" viewBox="-0.2 -2.4 8.9 9"', svg)
+
+        # The view box grows to the notes above the staff.
+        svg = staff.render_svg('treble', [DiatonicPitch(44, 0)])
+        self.assertIn('width="13.35mm" height="18mm" viewBox="-0.2 -5.4 8.9 12"', svg)
+
+        # and below it
+        svg = staff.render_svg('treble', [DiatonicPitch(22, 0)])
+        self.assertIn('width="13.35mm" height="17.1mm" viewBox="-0.2 -2.4 8.9 11.4"', svg)
+
+        svg = staff.render_svg('bass', [DiatonicPitch(18, 0), DiatonicPitch(20, 0)], skip=2)
+        self.assertIn('width="30.6mm" height="13.5mm" viewBox="-0.2 -2.4 20.4 9"', svg)
+
+class MemoryCacheTests(TestCase):
+    def test_lru_entries(self):
+        cache = MemoryCache(max_entries=2, max_bytes=1000)
+        cache.put('a', '<svg>a</svg>')
+        cache.put('b', '<svg>b</svg>')
+        self.assertEqual(cache.get('a'), '<svg>a</svg>') # a is now most recently used
+        cache.put('c', '<svg>c</svg>')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), '<svg>a</svg>')
+        self.assertEqual(cache.get('c'), '<svg>c</svg>')
+        self.assertEqual(cache.stats()['hits'], 3)
+        self.assertEqual(cache.stats()['misses'], 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_bytes(self):
+        cache = MemoryCache(max_entries=10, max_bytes=10)
+        cache.put('a', 'x'*4)
+        cache.put('b', 'x'*4)
+        cache.put('c', 'x'*4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get('a'), None)
+
+        # Entries larger than the whole cache are not stored at all.
+        cache.put('d', 'x'*11)
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(len(cache), 2)
+
+    def test_replace(self):
+        cache = MemoryCache(max_entries=10, max_bytes=10)
+        cache.put('a', 'x'*4)
+        cache.put('a', 'x'*6)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 6)
+
+def fake_svg(lilysrc: str) -> str:
+    return '<svg>{}</svg>\n'.format(lilysrc)
+
+def fake_render(jobs: {}):
+    """writes a dummy svg for each rendering job instead of running lilypond"""
+    for filename, lilysrc in jobs.items():
+        with open(filename, 'w') as file:
+            file.write(fake_svg(lilysrc))
+
+class GenerateSvgTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patchers = [
+            mock.patch.object(lilypond, 'CACHE_DIR', self.cache_dir.name),
+            mock.patch.object(lilypond, 'memory_cache', MemoryCache(100, 10000)),
+            mock.patch.object(lilypond, '_render', side_effect=fake_render),
+            mock.patch.object(lilypond, 'RENDER_WORKERS', 1),
+            mock.patch.object(lilypond, 'RENDERER', 'lilypond'),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_batch(self):
+        c, d, e = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in [28, 29, 30]]
+        svgs = lilypond.generate_svgs([c, d, c])
+        self.assertEqual(svgs, [fake_svg(s.lilysrc) for s in [c, d, c]])
+        self.assertEqual(lilypond._render.call_count, 1)
+        self.assertEqual(sorted(lilypond._render.call_args[0][0].values()), [c.lilysrc, d.lilysrc])
+
+        # Only the missing snippets are rendered.
+        lilypond.memory_cache.clear()
+        svgs = lilypond.generate_svgs([c, e])
+        self.assertEqual(svgs, [fake_svg(s.lilysrc) for s in [c, e]])
+        self.assertEqual(lilypond._render.call_count, 2)
+        self.assertEqual(list(lilypond._render.call_args[0][0].values()), [e.lilysrc])
+
+    def test_memory_tier(self):
+        c = lilypond.note_snippet('treble', DiatonicPitch(28, 0))
+        lilypond.generate_svg(c)
+        os.remove(lilypond._cache_filename(c, lilypond.get_renderer()))
+        self.assertEqual(lilypond.generate_svg(c), fake_svg(c.lilysrc))
+        self.assertEqual(lilypond._render.call_count, 1)
+
+    def test_atomic_write(self):
+        snippets = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in range(28, 30)]
+        with mock.patch.object(lilypond, 'CACHE_DIR', os.path.join(self.cache_dir.name, 'new')):
+            lilypond.generate_svgs(snippets)
+            # Only the complete cache entries remain, no temporary files or directories.
+            generation = lilypond.get_renderer().generation()
+            self.assertEqual(os.listdir(lilypond.CACHE_DIR), [generation])
+            self.assertEqual(sorted(os.listdir(os.path.join(lilypond.CACHE_DIR, generation))), sorted(
+                '{}.preview.svg{}'.format(os.path.basename(lilypond.get_renderer().cache_key(s)), ext)
+                for s in snippets for ext in ['', '.gz'] + (['.br'] if lilypond.brotli else [])
+            ))
+            # Readable by the reverse proxy.
+            for name in os.listdir(os.path.join(lilypond.CACHE_DIR, generation)):
+                mode = os.stat(os.path.join(lilypond.CACHE_DIR, generation, name)).st_mode & 0o777
+                self.assertEqual(mode, 0o644 & ~lilypond._umask)
+
+    def test_single_flight(self):
+        def slow_render(jobs: {}):
+            time.sleep(0.2)
+            fake_render(jobs)
+        lilypond._render.side_effect = slow_render
+
+        c = lilypond.note_snippet('treble', DiatonicPitch(28, 0))
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(lilypond.prerender([c]))) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(lilypond._render.call_count, 1)
+        self.assertEqual(sorted(results), [0, 0, 0, 1])
+        self.assertFalse(os.path.exists(lilypond._cache_filename(c, lilypond.get_renderer()) + '.lock'))
+
+    def test_crossed_waiters(self):
+        a, b = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in [28, 29]]
+        filenames = [lilypond._cache_filename(s, lilypond.get_renderer()) for s in [a, b]]
+        os.makedirs(os.path.dirname(filenames[0]))
+        locks = [lilypond._lock(f, blocking=False) for f in filenames]
+
+        # Two requests wait for the same snippets in a different order.
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(lilypond.prerender([a, b]))),
+            threading.Thread(target=lambda: results.append(asyncio.run(lilypond.generate_svg_keys_async([b, a])))),
+        ]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        for filename in filenames:
+            with open(filename, 'w') as file:
+                file.write(fake_svg(''))
+        # The second request gets b first, while the first one still waits for
+        # a. The locks are released without removing the lock files, like by a
+        # renderer which died, so all requests lock the same files.
+        os.close(locks[1])
+        time.sleep(0.2)
+        os.close(locks[0])
+        for t in threads:
+            t.join(5)
+            self.assertFalse(t.is_alive())
+        self.assertEqual(len(results), 2)
+        self.assertEqual(lilypond._render.call_count, 0)
+
+    def test_wait_timeout(self):
+        c = lilypond.note_snippet('treble', DiatonicPitch(28, 0))
+        filename = lilypond._cache_filename(c, lilypond.get_renderer())
+        os.makedirs(os.path.dirname(filename))
+        fd = lilypond._lock(filename, blocking=False)
+        self.addCleanup(lilypond._unlock, filename, fd)
+        with mock.patch.object(lilypond, 'RENDER_WAIT_TIMEOUT', 0.1):
+            with self.assertRaises(lilypond.RenderError):
+                lilypond.prerender([c])
+            with self.assertRaises(lilypond.RenderError):
+                asyncio.run(lilypond.generate_svg_keys_async([c]))
+        self.assertEqual(lilypond._render.call_count, 0)
+
+    def test_parallel(self):
+        snippets = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in range(28, 33)]
+        with mock.patch.object(lilypond, 'RENDER_WORKERS', 2):
+            svgs = lilypond.generate_svgs(snippets)
+        self.assertEqual(svgs, [fake_svg(s.lilysrc) for s in snippets])
+        self.assertEqual(lilypond._render.call_count, 2)
+        batches = sorted(len(c[0][0]) for c in lilypond._render.call_args_list)
+        self.assertEqual(batches, [2, 3])
+
+    def test_native_renderer(self):
+        renderer = lilypond.get_renderer('native')
+        snippets = [
+            lilypond.note_snippet('treble', DiatonicPitch(44, -2)),
+            lilypond.interval_snippet('bass', DiatonicPitch(12, 1), DiatonicPitch(20, 2)),
+            lilypond.scale_snippet('treble', DiatonicPitch(29, 0), DiatonicPitch(36, 0)),
+        ]
+        svgs = lilypond.generate_svgs(snippets, renderer)
+        self.assertEqual(lilypond._render.call_count, 0)
+        for s, svg in zip(snippets, svgs):
+            self.assertEqual(svg, minify(staff.render_svg(s.clef, s.pitches, s.skip)))
+
+        # Rendered separately from the lilypond backend.
+        self.assertNotEqual(renderer.cache_key(snippets[0]), lilypond.get_renderer('lilypond').cache_key(snippets[0]))
+
+    def test_prerender_exercise(self):
+        ex = ScaleExercise.objects.create(title='Scales', clef=Clefs.TREBLE_BASS, max_sharps=1, max_flats=1)
+        snippets = get_exercise_snippets(ex)
+        self.assertEqual(len(snippets), 2*3*2) # clefs * key signatures * directions
+        self.assertEqual(lilypond.prerender(snippets), len(snippets))
+        self.assertEqual(lilypond.prerender(snippets), 0)
+
+    def test_async(self):
+        c, d = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in [28, 29]]
+        with mock.patch.object(lilypond, 'LILYPOND_WORKERS', True):
+            svgs = asyncio.run(lilypond.generate_svgs_async([c, d, c]))
+        self.assertEqual(svgs, [fake_svg(s.lilysrc) for s in [c, d, c]])
+        self.assertEqual(asyncio.run(lilypond.generate_svgs_async([d])), [fake_svg(d.lilysrc)])
+        self.assertEqual(lilypond._render.call_count, 1)
+
+    def test_async_disk_io_off_loop(self):
+        calls = []
+        def record(f):
+            def wrapper(*args, **kwargs):
+                try:
+                    asyncio.get_running_loop()
+                    calls.append((f.__name__, 'loop'))
+                except RuntimeError:
+                    calls.append((f.__name__, 'thread'))
+                return f(*args, **kwargs)
+            return wrapper
+
+        snippets = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in [28, 29]]
+        with mock.patch.object(lilypond, '_publish', record(lilypond._publish)), \
+             mock.patch.object(cachedir, 'prune', record(cachedir.prune)), \
+             mock.patch.object(lilypond, '_read_rendered', record(lilypond._read_rendered)), \
+             mock.patch.object(cachedir, '_unpruned_bytes', cachedir.CACHE_MAX_BYTES):
+            svgs = asyncio.run(lilypond.generate_svgs_async(snippets))
+        self.assertEqual(svgs, [fake_svg(s.lilysrc) for s in snippets])
+        self.assertEqual(sorted(calls), [('_publish', 'thread')]*2 + [('_read_rendered', 'thread'), ('prune', 'thread')])
+
+    def test_prune(self):
+        snippets = [lilypond.note_snippet('treble', DiatonicPitch(p, 0)) for p in range(28, 32)]
+        filenames = [lilypond._cache_filename(s, lilypond.get_renderer()) for s in snippets]
+        lilypond.prerender(snippets)
+        for i, filename in enumerate(filenames):
+            os.utime(filename, (1000+i, 1000+i))
+        lilypond.read_svg(lilypond.get_renderer().cache_key(snippets[0]))
+
+        sizes = {f: size for _, size, f in cachedir._entries(os.path.dirname(filenames[0]))}
+        max_bytes = sizes[filenames[0]] + sizes[filenames[3]]
+        self.assertEqual(cachedir.prune(max_bytes), (2, sizes[filenames[1]] + sizes[filenames[2]]))
+        # The least recently used entries are evicted.
+        self.assertEqual([os.path.exists(f) for f in filenames], [True, False, False, True])
+
+    def test_gc(self):
+        old_dir = os.path.join(lilypond.CACHE_DIR, 'lilypond-00000000')
+        os.makedirs(old_dir)
+        with open(os.path.join(old_dir, 'a.preview.svg'), 'w') as file:
+            file.write(fake_svg(''))
+        with open(os.path.join(lilypond.CACHE_DIR, 'b.preview.svg'), 'w') as file:
+            file.write(fake_svg(''))
+        lilypond.generate_svg(lilypond.note_snippet('treble', DiatonicPitch(28, 0)))
+
+        stats = cachedir.cache_stats()
+        self.assertEqual(sorted((g['name'], g['current']) for g in stats['generations']),
+                         sorted([(lilypond.get_renderer().generation(), True), ('lilypond-00000000', False)]))
+        with mock.patch.object(lilypond.LilypondRenderer, 'available', return_value=True), \
+                mock.patch.object(cachedir, 'CACHE_KEEP_GENERATIONS', 0):
+            self.assertEqual(cachedir.gc()[0], 2)
+        self.assertEqual(cachedir.cache_stats()['entries'], 1)
+
+    def test_gc_kept_generations(self):
+        current = lilypond.get_renderer().generation()
+        lilypond.generate_svg(lilypond.note_snippet('treble', DiatonicPitch(28, 0)))
+        old = ['lilypond-0000000{}'.format(i) for i in range(3)]
+        for i, name in enumerate(old):
+            os.makedirs(os.path.join(lilypond.CACHE_DIR, name))
+            with open(os.path.join(lilypond.CACHE_DIR, name, 'a.preview.svg'), 'w') as file:
+                file.write(fake_svg(''))
+            os.utime(os.path.join(lilypond.CACHE_DIR, name), (1000+i, 1000+i))
+        generations = lambda: sorted(g['name'] for g in cachedir.cache_stats()['generations'])
+
+        # Without lilypond the current generation is unknown, nothing is removed.
+        with mock.patch.object(lilypond.LilypondRenderer, 'available', return_value=False):
+            self.assertEqual(cachedir.prune()[0], 0)
+        self.assertEqual(generations(), sorted(old + [current]))
+
+        # The current and the most recently written other generation are kept.
+        with mock.patch.object(lilypond.LilypondRenderer, 'available', return_value=True):
+            self.assertEqual(cachedir.prune()[0], 2)
+        self.assertEqual(generations(), sorted([old[2], current]))
+
+    def test_stats(self):
+        c = lilypond.note_snippet('treble', DiatonicPitch(28, 0))
+        with mock.patch.object(cachedir, '_counters', {'disk_hits': 0, 'disk_misses': 0}):
+            lilypond.generate_svg(c)
+            lilypond.generate_svg(c)
+            lilypond.prerender([c])
+            cachedir.flush_stats()
+        stats = cachedir.cache_stats()
+        self.assertEqual((stats['memory_hits'], stats['memory_misses']), (1, 1))
+        self.assertEqual((stats['disk_hits'], stats['disk_misses']), (1, 1))
+
+    def test_stats_expire(self):
+        stats_dir = os.path.join(lilypond.CACHE_DIR, cachedir.STATS_DIR)
+        os.makedirs(stats_dir)
+        for name, age in [('1-1000.json', cachedir.STATS_MAX_AGE+60), ('2-1000.json', 60)]:
+            with open(os.path.join(stats_dir, name), 'w') as file:
+                json.dump({'disk_hits': 1}, file)
+            os.utime(os.path.join(stats_dir, name), (time.time()-age, time.time()-age))
+
+        # Counters of a process gone for a day aren't reported nor kept.
+        self.assertEqual(cachedir.cache_stats()['disk_hits'], 1)
+        cachedir.gc()
+        self.assertEqual(os.listdir(stats_dir), ['2-1000.json'])
+
+# Speaks the lilyworker protocol and writes a fake svg for every book.
+FAKE_WORKER = r"""
+import os, re, sys
+print('\nnotecheck-ready', flush=True)
+for filename in sys.stdin:
+    lilysrc = open(filename.strip()).read()
+    if 'crash' in lilysrc:
+        sys.exit(1)
+    if 'error' in lilysrc:
+        print('error\nnotecheck-error', flush=True)
+        continue
+    for name in re.findall(r'bookOutputName "(.*)"', lilysrc):
+        open(os.path.join(os.path.dirname(filename.strip()), name + '.preview.svg'), 'w').write('<svg/>')
+    print('rendering\nnotecheck-ok', flush=True)
+"""
+
+class LilyWorkerTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        self.pool = lilyworker.WorkerPool()
+        self.addCleanup(self.pool.close)
+        self.render_process = lilypond._render_process
+        self.worker_cmd = lilyworker.WORKER_CMD
+        patchers = [
+            mock.patch.object(lilyworker, 'WORKER_CMD', [sys.executable, '-c', FAKE_WORKER]),
+            mock.patch.object(lilyworker, 'pool', self.pool),
+            mock.patch.object(lilypond, 'LILYPOND_WORKERS', True),
+            mock.patch.object(lilypond, '_render_process', return_value=''),
+            mock.patch.object(lilypond, 'CACHE_DIR', self.cache_dir.name),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def render(self, name: str):
+        filename = os.path.join(self.cache_dir.name, name + '.preview.svg')
+        try:
+            lilypond._render({filename: "{ c'1 }"})
+        except lilypond.RenderError:
+            return False
+        return True
+
+    def test_reuse(self):
+        self.assertTrue(self.render('a'))
+        self.assertTrue(self.render('b'))
+        self.assertEqual(self.pool.started, 1)
+        self.assertFalse(lilypond._render_process.called)
+
+        with mock.patch.object(lilyworker, 'WORKER_MAX_JOBS', 1):
+            self.assertTrue(self.render('c'))
+            self.assertTrue(self.render('d'))
+        # The worker is retired after its last job and replaced by a new one.
+        self.assertEqual(self.pool.started, 2)
+
+    def test_crash(self):
+        with self.assertLogs(lilypond.logger, 'WARNING'):
+            self.assertFalse(self.render('crash'))
+        self.assertEqual(lilypond._render_process.call_count, 1)
+        # Crashed worker is replaced.
+        self.assertTrue(self.render('a'))
+        self.assertEqual(self.pool.started, 2)
+
+    def test_error(self):
+        with self.assertLogs(lilypond.logger, 'WARNING'):
+            self.assertFalse(self.render('error'))
+        self.assertEqual(lilypond._render_process.call_count, 1)
+        # The worker which failed a job isn't reused.
+        self.assertTrue(self.render('a'))
+        self.assertEqual(self.pool.started, 2)
+
+    def test_unavailable(self):
+        with mock.patch.object(lilyworker, 'WORKER_CMD', [sys.executable, '-c', 'pass']), \
+             self.assertLogs(lilypond.logger, 'WARNING'):
+            self.assertFalse(self.render('a'))
+        self.assertFalse(self.pool.available)
+        self.assertFalse(self.pool.supported)
+        self.assertEqual(lilypond._render_process.call_count, 1)
+        self.render('b')
+        self.assertEqual(lilypond._render_process.call_count, 2)
+
+    def test_start_retry(self):
+        for cmd in [[sys.executable, '-c', 'import time; time.sleep(10)'], ['/nonexistent/lilypond']]:
+            with mock.patch.object(lilyworker, 'WORKER_CMD', cmd), mock.patch.object(lilyworker, 'WORKER_TIMEOUT', 0.2), \
+                 self.assertLogs(lilypond.logger, 'WARNING'):
+                self.assertFalse(self.render('a'))
+            # Workers are tried again after the backoff delay.
+            self.assertTrue(self.pool.supported)
+            self.assertFalse(self.pool.available)
+            self.render('b')
+            self.assertEqual(lilypond._render_process.call_count, 2)
+
+            self.pool._retry_at = 0
+            self.assertTrue(self.render('c'))
+            self.assertEqual(lilypond._render_process.call_count, 2)
+            self.pool.close()
+            lilypond._render_process.reset_mock()
+        self.assertEqual(self.pool.started, 2)
+
+    def test_process_errors(self):
+        lilypond._render_process.side_effect = self.render_process
+        self.pool.supported = False
+        jobs = {os.path.join(self.cache_dir.name, 'a.preview.svg'): "{ c'1 }"}
+
+        with mock.patch.object(lilypond, 'LILYPOND_CMD', 'false'), self.assertLogs(lilypond.logger, 'ERROR'):
+            with self.assertRaises(lilypond.RenderError) as cm:
+                lilypond._render(jobs)
+        self.assertEqual(cm.exception.returncode, 1)
+
+        start = time.monotonic()
+        with mock.patch.object(lilypond, 'LILYPOND_CMD', 'sleep 10'), mock.patch.object(lilypond, 'RENDER_TIMEOUT', 0.2), \
+             self.assertLogs(lilypond.logger, 'ERROR'):
+            with self.assertRaisesRegex(lilypond.RenderError, 'timed out'):
+                lilypond._render(jobs)
+        self.assertLess(time.monotonic()-start, 5)
+
+    def test_process_errors_async(self):
+        self.pool.supported = False
+        jobs = {os.path.join(self.cache_dir.name, 'a.preview.svg'): "{ c'1 }"}
+
+        with mock.patch.object(lilypond, 'LILYPOND_CMD', 'false'), self.assertLogs(lilypond.logger, 'ERROR'):
+            with self.assertRaises(lilypond.RenderError) as cm:
+                asyncio.run(lilypond._render_async(jobs))
+        self.assertEqual(cm.exception.returncode, 1)
+
+        start = time.monotonic()
+        with mock.patch.object(lilypond, 'LILYPOND_CMD', 'sleep 10'), mock.patch.object(lilypond, 'RENDER_TIMEOUT', 0.2), \
+             self.assertLogs(lilypond.logger, 'ERROR'):
+            with self.assertRaisesRegex(lilypond.RenderError, 'timed out'):
+                asyncio.run(lilypond._render_async(jobs))
+        self.assertLess(time.monotonic()-start, 5)
+
+    @skipIf(shutil.which('lilypond') is None, 'lilypond is not installed')
+    def test_lilypond(self):
+        lilypond._render_process.side_effect = self.render_process
+        snippets = [
+            lilypond.note_snippet('treble', DiatonicPitch(30, 1)),
+            lilypond.interval_snippet('bass', DiatonicPitch(12, -1), DiatonicPitch(16, 0)),
+        ]
+        outputs = []
+        for name in ['worker', 'process']:
+            os.mkdir(os.path.join(self.cache_dir.name, name))
+            jobs = {os.path.join(self.cache_dir.name, name, '{}.preview.svg'.format(i)): s.lilysrc for i, s in enumerate(snippets)}
+            with mock.patch.object(lilyworker, 'WORKER_CMD', self.worker_cmd):
+                self.pool.supported = name == 'worker'
+                lilypond._render(jobs)
+            outputs.append([open(filename).read() for filename in jobs])
+
+        # The worker's scheme loop ran and its output equals the one of a lilypond process per batch.
+        self.assertEqual(self.pool.started, 1)
+        self.assertEqual(lilypond._render_process.call_count, 1)
+        self.assertIn('<svg', outputs[0][0])
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_slots(self):
+        with mock.patch.object(lilypond, 'MAX_LILYPOND_PROCESSES', 1), \
+             mock.patch.object(lilypond, 'RENDER_QUEUE_TIMEOUT', 0.2):
+            with lilypond._render_slot():
+                with self.assertRaisesRegex(lilypond.RenderError, 'slots busy'):
+                    lilypond._render({os.path.join(self.cache_dir.name, 'a.preview.svg'): "{ c'1 }"})
+            self.assertTrue(self.render('a'))
+
+    def test_slot_short_timeout(self):
+        # A free slot is taken even if the timeout is shorter than the first polling delay.
+        with mock.patch.object(lilypond, 'RENDER_QUEUE_TIMEOUT', 0):
+            with lilypond._render_slot():
+                pass
+            asyncio.run(self.enter_slot_async())
+
+        # The slot is polled once more at the deadline.
+        calls = []
+        acquire = lilypond._render_slot._acquire
+        def acquire_second(slot):
+            calls.append(time.monotonic())
+            return len(calls) > 1 and acquire(slot)
+        with mock.patch.object(lilypond, 'RENDER_QUEUE_TIMEOUT', 0.005), \
+             mock.patch.object(lilypond._render_slot, '_acquire', acquire_second):
+            with lilypond._render_slot():
+                pass
+        self.assertEqual(len(calls), 2)
+
+    async def enter_slot_async(self):
+        async with lilypond._render_slot():
+            pass
+
+class ExerciseTypeTests(TestCase):
+    def test_get_instance(self):
+        for e_class in [NotePitchExercise, IntervalExercise, ScaleExercise]:
+            ex = e_class.objects.create(title='Exercise')
+            self.assertEqual(ex.type, e_class.TYPE)
+            self.assertIs(type(Exercise.objects.get(token=ex.token).get_instance()), e_class)
+
+            s = Submission.objects.create(token=ex, seed=1)
+            with self.assertNumQueries(1):
+                s = Submission.objects.select_related('token', *['token__' + r for r in EXERCISE_RELATED]).get(pk=s.pk)
+                submission = s.get_instance()
+                self.assertIs(type(submission), SUBMISSION_CLASSES[e_class.TYPE])
+                self.assertIs(type(submission.token.get_instance()), e_class)
+                self.assertEqual(submission.get_instance(), submission)
+
+    def test_memoize(self):
+        ex = IntervalExercise.objects.create(title='Intervals')
+        s = Submission.objects.create(token=ex, seed=1, answers=['']*ex.num_questions)
+        s = Submission.objects.get(pk=s.pk)
+        self.assertEqual(s.get_score('sl'), 0)
+        with self.assertNumQueries(0):
+            self.assertEqual(s.get_score('sl'), 0)
+            expected = s.get_expected_answers('sl')
+            self.assertIs(s.get_instance().get_pitch_pairs(), s.get_instance().get_pitch_pairs())
+
+            # Changed answers are scored again.
+            s.answers = expected
+            self.assertEqual(s.get_score('sl'), ex.num_questions)
+
+    def test_instance_of_copy(self):
+        ex = IntervalExercise.objects.create(title='Intervals')
+        s = Submission.objects.get(pk=Submission.objects.create(token=ex, seed=1).pk)
+        s.get_instance().get_pitch_pairs()
+        for s2 in [copy.copy(s), pickle.loads(pickle.dumps(s))]:
+            s2.seed = 999
+            self.assertEqual(s2.get_instance().seed, 999)
+            self.assertNotEqual(s2.get_instance().get_pitch_pairs(), s.get_instance().get_pitch_pairs())
+        self.assertEqual(s.get_instance().seed, 1)
+
+class StoredScoreTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.cache_dir.cleanup)
+        for p in [mock.patch.object(lilypond, 'CACHE_DIR', self.cache_dir.name), mock.patch.object(lilypond, 'RENDERER', 'native')]:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def test_finalize(self):
+        ex = NotePitchExercise.objects.create(title='Pitches')
+        self.client.get('/{}/'.format(ex.token))
+        s = Submission.objects.get(token=ex)
+        expected = s.get_expected_answers(settings.LANGUAGE_CODE)
+        answers = {'answer{}'.format(i): a for i, a in enumerate(expected)}
+        answers['answer0'] = ''
+        self.client.post('/{}/'.format(ex.token), dict(answers, submission_id=s.pk))
+
+        s = Submission.objects.get(pk=s.pk)
+        self.assertEqual((s.score, s.max_score), (ex.num_questions-1, ex.num_questions))
+        self.assertEqual(s.score_vector, [False] + [True]*(ex.num_questions-1))
+        with mock.patch.object(NotePitchSubmission, 'compute_score_vector') as compute:
+            self.assertEqual(s.get_score(settings.LANGUAGE_CODE), ex.num_questions-1)
+            self.assertFalse(compute.called)
+
+    def test_rescore(self):
+        ex = IntervalExercise.objects.create(title='Intervals')
+        s = Submission.objects.create(token=ex, seed=1, answers=['']*ex.num_questions, duration=timedelta(seconds=10))
+        Submission.objects.create(token=ex, seed=2, answers=['']*ex.num_questions)
+        call_command('rescore', stdout=mock.MagicMock())
+        s = Submission.objects.get(pk=s.pk)
+        self.assertEqual((s.score, s.max_score), (0, ex.num_questions))
+        self.assertEqual(Submission.objects.filter(score__isnull=True).count(), 1) # not finalized
+
+    def test_rescore_bulk(self):
+        exercises = [
+            NotePitchExercise.objects.create(title='Pitches', num_questions=5),
+            IntervalExercise.objects.create(title='Intervals', num_questions=5),
+            ScaleExercise.objects.create(title='Scales', num_questions=2),
+        ]
+        for ex in exercises:
+            for seed in range(7):
+                s = Submission.objects.create(token=ex, seed=seed, duration=timedelta(seconds=10))
+                s.answers = s.get_expected_answers(settings.LANGUAGE_CODE)
+                s.save()
+
+        # A select of the submissions, each exercise is loaded once and each chunk of 4 is written back at once.
+        with self.assertNumQueries(1 + 3 + 6):
+            self.assertEqual(scoring.rescore(scoring.finalized_submissions(), chunk_size=4)[0], 21)
+        self.assertEqual(Submission.objects.filter(perfect=True).count(), 21)
+
+        Submission.objects.update(score=None, score_vector=None, perfect=False)
+        stdout = io.StringIO()
+        call_command('rescore', '--exercise', str(exercises[1].token), stdout=stdout)
+        self.assertIn('Rescored 7 submissions', stdout.getvalue())
+        self.assertIn('submissions/s', stdout.getvalue())
+        self.assertEqual(set(Submission.objects.filter(perfect=True).values_list('token', flat=True)), {exercises[1].token})
+
+        with self.assertRaises(CommandError):
+            call_command('rescore', '--exercise', 'nonexistent', stdout=stdout)
+
+    def test_besttime_leaderboard(self):
+        ex = IntervalExercise.objects.create(title='Intervals')
+        for seed, seconds in [(1, 70), (2, 65), (3, 60)]:
+            s = Submission.objects.create(token=ex, seed=seed, duration=timedelta(seconds=seconds))
+            s.answers = s.get_expected_answers(settings.LANGUAGE_CODE)
+            if seed == 3:
+                s.answers[0] = ''
+            s.store_score()
+            s.save()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(s.get_besttime(settings.LANGUAGE_CODE), timedelta(seconds=65))
+
+        response = self.client.get('/{}/leaderboard/'.format(ex.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([s['duration'] for s in response.context['submissions']], ['1:05', '1:10'])
+
+class SubmissionAdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+        self.client.force_login(User.objects.create_superuser('admin'))
+
+    def add_submissions(self, ex, n: int):
+        for seed in range(n):
+            s = Submission.objects.create(token=ex, seed=seed, duration=timedelta(seconds=10))
+            s.answers = ['']*len(s.get_expected_answers(settings.LANGUAGE_CODE))
+            s.save()
+            if seed % 2:
+                s.store_score()
+                s.save()
+
+    def test_changelist(self):
+        ex = NotePitchExercise.objects.create(title='Pitches')
+        self.add_submissions(ex, 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/admin/notecheck/submission/').status_code, 200)
+        self.add_submissions(IntervalExercise.objects.create(title='Intervals'), 10)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get('/admin/notecheck/submission/')
+        self.assertContains(response, '0 / 20', count=12)
+
+    def test_export(self):
+        ex = ScaleExercise.objects.create(title='Scales', num_questions=2)
+        self.add_submissions(ex, 2)
+        response = self.client.get('/admin/notecheck/submission/export.csv?token__token__exact={}'.format(ex.token))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(lines[0], ','.join(SubmissionAdmin.EXPORT_FIELDS))
+        self.assertEqual(len(lines), 3)
+
+        response = self.client.get('/admin/notecheck/submission/export.json')
+        self.assertEqual([(r['score'], r['max_score']) for r in response.json()], [(0, 16), (0, 16)])
+
+    def test_export_permission(self):
+        from django.contrib.auth.models import Permission, User
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        for url in ['/admin/notecheck/submission/export.csv', '/admin/notecheck/submission/export.json']:
+            self.assertEqual(self.client.get(url).status_code, 403)
+
+        staff.user_permissions.add(Permission.objects.get(codename='view_submission'))
+        for url in ['/admin/notecheck/submission/export.csv', '/admin/notecheck/submission/export.json']:
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_change(self):
+        ex = NotePitchExercise.objects.create(title='Pitches', num_questions=2)
+        self.add_submissions(ex, 2)
+        s = Submission.objects.get(token=ex, seed=1)
+        self.assertEqual(s.score, 0)
+
+        from django.contrib.admin import site
+        form = site._registry[Submission].get_form(RequestFactory().get('/'), s)
+        self.assertFalse({'score', 'max_score', 'score_vector', 'perfect'} & set(form.base_fields))
+
+        answers = s.get_expected_answers(settings.LANGUAGE_CODE)
+        response = self.client.post('/admin/notecheck/submission/{}/change/'.format(s.pk), {
+            'token': str(ex.pk),
+            'seed': s.seed,
+            'answers': json.dumps(answers),
+            'duration': '00:00:10',
+        })
+        self.assertEqual(response.status_code, 302)
+        s.refresh_from_db()
+        self.assertEqual((s.score, s.max_score, s.perfect), (len(answers), len(answers), True))
+
+class ExerciseCandidateTests(TestCase):
+    def test_note_pitch_candidates(self):
+        ex = NotePitchExercise.objects.create(title='Pitches', clef=Clefs.TREBLE_BASS, max_sharps=1, max_flats=2)
+        self.assertEqual(len(ex.get_candidate_pitches(Clefs.TREBLE)), 20*4)
+        for seed in range(20):
+            for version in [1, 2]:
+                submission = NotePitchSubmission.objects.create(token=ex, seed=seed, generator_version=version)
+                pitches = submission.get_pitches()
+                for i, p in enumerate(pitches):
+                    self.assertIn(p, ex.get_candidate_pitches(submission.get_clef(ex, i)))
+                    self.assertNotEqual(p, pitches[i-1] if i else None)
+
+    def test_interval_candidates(self):
+        ex = IntervalExercise.objects.create(title='Intervals', direction=-1, max_quantity=5)
+        candidates = ex.get_candidate_pitch_pairs(Clefs.TREBLE)
+        for p1, p2 in candidates:
+            self.assertTrue(p1.pitch-4 <= p2.pitch <= p1.pitch)
+        for seed in range(20):
+            for version in [1, 2]:
+                submission = IntervalSubmission.objects.create(token=ex, seed=seed, generator_version=version)
+                for p in submission.get_pitch_pairs():
+                    self.assertIn(p, candidates)
+
+    def test_scale_candidates(self):
+        ex = ScaleExercise.objects.create(title='Scales', gender=ScaleGender.MINOR, shape=ScaleShape.HARMONIC)
+        candidates = ex.get_candidate_scales(Clefs.TREBLE)
+        self.assertEqual(len(candidates), 15*2)
+        for seed in range(20):
+            for version in [1, 2]:
+                submission = ScaleSubmission.objects.create(token=ex, seed=seed, generator_version=version)
+                scales = submission.get_scales()
+                for i, s in enumerate(scales):
+                    self.assertIn(s, candidates)
+                    self.assertNotEqual(s, scales[i-1] if i else None)
+
+    def test_generator_versions(self):
+        ex = IntervalExercise.objects.create(title='Intervals', max_quantity=5, num_questions=4)
+        self.assertEqual(IntervalSubmission.objects.create(token=ex, seed=7).generator_version, GENERATOR_VERSION)
+
+        # Seeds of the older submissions reproduce their questions.
+        submission = IntervalSubmission.objects.create(token=ex, seed=7, generator_version=1)
+        self.assertEqual(IntervalSubmission.objects.get(pk=submission.pk).get_pitch_pairs(), [
+            (DiatonicPitch(26, 1), DiatonicPitch(27, -1)), (DiatonicPitch(28, 1), DiatonicPitch(32, 1)),
+            (DiatonicPitch(38, 0), DiatonicPitch(35, 1)), (DiatonicPitch(39, 0), DiatonicPitch(36, -1)),
+        ])
+
+    def test_single_candidate(self):
+        ex = ScaleExercise.objects.create(title='C major', direction=1, max_sharps=0, max_flats=0, num_questions=3)
+        submission = ScaleSubmission.objects.create(token=ex, seed=1)
+        self.assertEqual(submission.get_scales(), [ex.get_scale(Clefs.TREBLE, 0, 1)]*3)
+
+class SvgViewTests(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        patchers = [
+            mock.patch.object(lilypond, 'CACHE_DIR', self.cache_dir.name),
+            mock.patch.object(lilypond, 'RENDERER', 'native'),
+        ]
+        for p in patchers:
+            p.start()
+            self.addCleanup(p.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_svg(self):
+        key = lilypond.generate_svg_keys([lilypond.note_snippet('treble', DiatonicPitch(30, 0))])[0]
+        response = self.client.get('/svg/{}.svg'.format(key))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['ETag'], 'W/"{}"'.format(key))
+        self.assertNotIn('Content-Encoding', response)
+
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_IF_NONE_MATCH='W/"{}"'.format(key))
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), lilypond.read_svg(key)[0])
+
+        response = self.client.get('/svg/{}/{}.svg'.format(lilypond.get_renderer().generation(), '0'*32))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_svg(self):
+        key = '{}/{}'.format(lilypond.get_renderer().generation(), '0'*32)
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_IF_NONE_MATCH='W/"{}"'.format(key))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_IF_NONE_MATCH='*')
+        self.assertEqual(response.status_code, 404)
+
+    def test_memory_tier(self):
+        key = lilypond.generate_svg_keys([lilypond.note_snippet('treble', DiatonicPitch(30, 0))])[0]
+        with mock.patch.object(lilypond, 'memory_cache', MemoryCache(100, 100000)):
+            self.client.get('/svg/{}.svg'.format(key), HTTP_ACCEPT_ENCODING='gzip')
+            with mock.patch('builtins.open', side_effect=AssertionError('read from disk')):
+                response = self.client.get('/svg/{}.svg'.format(key), HTTP_ACCEPT_ENCODING='gzip')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                response = self.client.get('/svg/{}.svg'.format(key), HTTP_IF_NONE_MATCH='W/"{}"'.format(key))
+                self.assertEqual(response.status_code, 304)
+            self.assertEqual(lilypond.memory_cache.hits, 1)
+
+            cachedir.clear()
+            response = self.client.get('/svg/{}.svg'.format(key), HTTP_IF_NONE_MATCH='W/"{}"'.format(key))
+            self.assertEqual(response.status_code, 404)
+
+    def test_accepted_encodings(self):
+        self.assertEqual(views._accepted_encodings(''), [])
+        self.assertEqual(views._accepted_encodings('gzip, deflate, br'), ['br', 'gzip', 'deflate'])
+        self.assertEqual(views._accepted_encodings('br;q=0, gzip'), ['gzip'])
+        self.assertEqual(views._accepted_encodings('br;q=0.5, gzip;q=0.8'), ['gzip', 'br'])
+        self.assertEqual(views._accepted_encodings('*'), ['br', 'gzip'])
+        self.assertEqual(views._accepted_encodings('*;q=0.1, gzip;q=0'), ['br'])
+        self.assertEqual(views._accepted_encodings('GZIP ; Q=1, br;q=x'), ['gzip'])
+
+        key = lilypond.generate_svg_keys([lilypond.note_snippet('treble', DiatonicPitch(30, 0))])[0]
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        response = self.client.get('/svg/{}.svg'.format(key), HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertNotIn('Content-Encoding', response)
+
+    def test_submission(self):
+        ex = NotePitchExercise.objects.create(title='Pitches')
+        response = self.client.get('/{}/'.format(ex.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count(b'<img src="/svg/'), ex.num_questions)
+
+        request = RequestFactory().get('/{}/'.format(ex.token))
+        response = async_to_sync(views.submission_async)(request, str(ex.token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content.count(b'<img src="/svg/'), ex.num_questions)
+
+        with override_settings(NOTECHECK_INLINE_SVG=True):
+            response = self.client.get('/{}/'.format(ex.token))
+        self.assertEqual(response.content.count(b'<svg '), ex.num_questions+1) # shared definitions
+        self.assertIn(b'<use href="#nc-g0"', response.content)
+
+class MinifyTests(TestCase):
+    def test_minify(self):
+        svg = """<?xml version="1.0" standalone="no"?>
+<svg xmlns="http://www.w3.org/2000/svg" version="1.2" width="148.00mm" height="14.71mm" viewBox="3.5000 -0.0000 84.1959 8.3655">
+<!-- comment -->
+<title>snippet</title>
+<line transform="translate(5.6906, 2.0000)" stroke-width="0.1000" stroke="#000000" x1="0.0500" y1="-0.0000" x2="81.0002" y2="-0.0000"/>
+<path transform="translate(6.7906, 4.0000) scale(0.00412, -0.00412)" d="M-12 0c0 -29 22 -62 54 -62c39 0 59.12345 48 59 98z"/>
+</svg>
+"""
+        self.assertEqual(minify(svg),
+            '<svg xmlns="http://www.w3.org/2000/svg" version="1.2" width="148mm" height="14.71mm" viewBox="3.5 0 84.196 8.366">'
+            '<line transform="translate(5.691, 2)" stroke-width="0.1" stroke="#000000" x1="0.05" y1="0" x2="81" y2="0"/>'
+            '<path transform="translate(6.791, 4) scale(0.00412, -0.00412)" d="M-12 0c0 -29 22 -62 54 -62c39 0 59.123 48 59 98z"/>'
+            '</svg>\n'
+        )
+
+class ShareGlyphsTests(TestCase):
+    def test_share_glyphs(self):
+        glyph = 'M0 0C1 1 2 2 3 3C4 4 5 5 6 6C7 7 8 8 9 9Z'
+        svgs = [
+            '<svg><path transform="translate(1,2)" d="{}"/><path d="M0 0h1"/></svg>'.format(glyph),
+            '<svg><path d="{}" fill-rule="evenodd"></path></svg>'.format(glyph),
+        ]
+        defs, shared = share_glyphs(svgs)
+        self.assertEqual(defs.count('<path '), 1)
+        self.assertIn('<path id="nc-g0" d="{}"/>'.format(glyph), defs)
+        self.assertEqual(shared, [
+            '<svg><use href="#nc-g0" transform="translate(1,2)"/><path d="M0 0h1"/></svg>',
+            '<svg><use href="#nc-g0" fill-rule="evenodd"/></svg>',
+        ])
+
+        # Nothing to share.
+        self.assertEqual(share_glyphs(svgs[:1]), ('', svgs[:1]))
@@ -1,13 +1,18 @@
 from django.conf import settings
-from django.urls import path
+from django.urls import path, re_path
 from django.views.generic.base import RedirectView
 
 from . import views
 
+# Async submission view for ASGI deployments, see notecheckproject/asgi.py.
+submission = views.submission_async if getattr(settings, 'NOTECHECK_ASYNC_VIEWS', False) else views.submission
+
 urlpatterns = [
     path('favicon.ico/', RedirectView.as_view(url=settings.STATIC_URL + 'notecheck/favicon.ico')),
     path('playnotepitch/', views.playnotepitch),
+    re_path(r'^svg/(?P<key>[a-z]+-[0-9a-f]{8}/[0-9a-f]{32})\.svg$', views.svg, name='svg'),
     path('', views.index, name='index'),
-    path('<str:token>/', views.submission, name='submission'),
-    path('<str:token>/<int:submission_id>/', views.submission, name='submission'),
+    path('<str:token>/', submission, name='submission'),
+    path('<str:token>/<int:submission_id>/', submission, name='submission'),
+    path('<str:token>/leaderboard/', views.leaderboard, name='leaderboard'),
 ]
@@ -1,25 +1,45 @@
 import time
 from datetime import datetime, timezone
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.template import loader
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.http import condition
 from django.utils.translation import gettext_lazy as _
 
 from .models import *
 from .lilypond import *
+from .svgopt import share_glyphs
 
 def index(request):
     return HttpResponse("Missing exercise token.")
 
-def get_template(token):
-    if NotePitchExercise.objects.filter(token=token) or IntervalExercise.objects.filter(token=token):
-        return loader.get_template('notecheck/grid.html')
-    if ScaleExercise.objects.filter(token=token):
-        return loader.get_template('notecheck/scales.html')
-    raise TypeError
+TEMPLATES = {
+    ExerciseTypes.NOTE_PITCH: 'notecheck/grid.html',
+    ExerciseTypes.INTERVAL: 'notecheck/grid.html',
+    ExerciseTypes.SCALE: 'notecheck/scales.html',
+}
 
-def get_questions_answers(submission_abstract: Submission, lang: str) -> ([], []):
+def get_template(ex: Exercise):
+    if ex.type not in TEMPLATES:
+        raise TypeError
+    return loader.get_template(TEMPLATES[ex.type])
+
+def get_questions_answers(submission_abstract: Submission, lang: str) -> ([], [], str):
+    """return questions and answers of the submission and the shared svg definitions of inlined questions"""
+    questions, answers, snippets = get_questions_snippets(submission_abstract, lang)
+    return questions, answers, add_svgs(questions, snippets)
+
+async def get_questions_answers_async(submission_abstract: Submission, lang: str) -> ([], [], str):
+    """asynchronous variant of get_questions_answers"""
+    questions, answers, snippets = await sync_to_async(get_questions_snippets)(submission_abstract, lang)
+    return questions, answers, await add_svgs_async(questions, snippets)
+
+def get_questions_snippets(submission_abstract: Submission, lang: str) -> ([], [], [Snippet]):
+    """return questions and answers of the submission and the snippets of the questions"""
     submission = submission_abstract.get_instance()
     ex = submission_abstract.token.get_instance()
     score_vector = submission.get_score_vector(lang)
@@ -29,44 +49,127 @@ def get_questions_answers(submission_abstract: Submission, lang: str) -> ([], []
     for i, a in enumerate(submission.answers):
         answers.append({"answer": a, "correct": score_vector[i], "index": i })
 
+    snippets = []
     if isinstance(submission, NotePitchSubmission):
         for i, p in enumerate(submission.get_pitches()):
-            lilysrc = "{{ \\omit Score.TimeSignature \\clef {clefname} {pitch}1 }}".format(
-                clefname=submission.get_clef(ex, i).lower(),
-                pitch=p.to_lilypond()
-            )
-            s = generate_svg(lilysrc)
-            questions.append( { "svg": s, "answers": [answers[i]] } )
+            snippets.append(note_snippet(submission.get_clef(ex, i), p))
+            questions.append( { "answers": [answers[i]] } )
     elif isinstance(submission, IntervalSubmission):
         for i, p in enumerate(submission.get_pitch_pairs()):
-            lilysrc = "{{ \\omit Score.TimeSignature \\clef {clefname} {pitch1}1 \\omit Score.BarLine {pitch2}1 }}".format(
-                clefname=submission.get_clef(ex, i).lower(),
-                pitch1=p[0].to_lilypond(),
-                pitch2=p[1].to_lilypond()
-            )
-            s = generate_svg(lilysrc)
-            questions.append( { "svg": s, "answers": [answers[i]] } )
+            snippets.append(interval_snippet(submission.get_clef(ex, i), p[0], p[1]))
+            questions.append( { "answers": [answers[i]] } )
     elif isinstance(submission, ScaleSubmission):
         for i, s in enumerate(submission.get_scales()):
-            lilysrc = "{{ \\omit Score.TimeSignature \\clef {clefname} {pitch1}1 \\omit Score.BarLine s1 s1 s1 s1 s1 s1 s1 s1 s1 s1 s1 s1 s1 s1 {pitch2}1 }}".format(
-                clefname=submission.get_clef(ex, i).lower(),
-                pitch1=s[0].to_lilypond(),
-                pitch2=s[-1].to_lilypond()
-            )
-            s = generate_svg(lilysrc)
-            questions.append( {"svg": s, "answers": answers[i*8 : (i+1)*8]} )
+            snippets.append(scale_snippet(submission.get_clef(ex, i), s[0], s[-1]))
+            questions.append( {"answers": answers[i*8 : (i+1)*8]} )
+
+    return questions, answers, snippets
+
+def add_svgs(questions: [], snippets: [Snippet]) -> str:
+    """renders all questions of the page at once, adds their svgs or svg urls to the questions
+    and returns the shared svg definitions of inlined questions"""
+    if getattr(settings, 'NOTECHECK_INLINE_SVG', False):
+        return _add_inline_svgs(questions, generate_svgs(snippets))
+    return _add_svg_urls(questions, generate_svg_keys(snippets))
+
+async def add_svgs_async(questions: [], snippets: [Snippet]) -> str:
+    """asynchronous variant of add_svgs"""
+    if getattr(settings, 'NOTECHECK_INLINE_SVG', False):
+        return _add_inline_svgs(questions, await generate_svgs_async(snippets))
+    return _add_svg_urls(questions, await generate_svg_keys_async(snippets))
+
+def _add_inline_svgs(questions: [], svgs: [str]) -> str:
+    svg_defs, svgs = share_glyphs(svgs)
+    for q, s in zip(questions, svgs):
+        q["svg"] = s
+    return svg_defs
+
+def _add_svg_urls(questions: [], keys: [str]) -> str:
+    for q, key in zip(questions, keys):
+        q["svg_url"] = reverse('svg', args=[key])
+    return ''
+
+# Precompressed variants of the svgs, preferred in this order if the client weighs them equally.
+SVG_ENCODINGS = ['br', 'gzip']
+
+def _accepted_encodings(header: str) -> [str]:
+    """returns content codings of the Accept-Encoding header the client accepts, most preferred first
+
+    Codings with q=0 are refused, '*' stands for the precompressed ones not listed."""
+    weights = {}
+    for item in header.split(','):
+        coding, *params = [p.strip() for p in item.split(';')]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.lower()] = q
+    if '*' in weights:
+        for coding in SVG_ENCODINGS:
+            weights.setdefault(coding, weights['*'])
+    order = lambda c: SVG_ENCODINGS.index(c) if c in SVG_ENCODINGS else len(SVG_ENCODINGS)
+    return sorted((c for c, q in weights.items() if q > 0 and c != '*'), key=lambda c: (-weights[c], order(c)))
+
+def _svg_etag(request, key):
+    """returns the etag of the svg or None for unknown keys, so they are never answered by 304"""
+    if not has_svg(key):
+        return None
+    return 'W/"{}"'.format(key)
+
+@condition(etag_func=_svg_etag)
+def svg(request, key):
+    """serves rendered svg from the memory cache or the cache dir, precompressed if
+    the client accepts it. The content of the key never changes."""
+    encodings = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    s, encoding = read_svg(key, encodings)
+    if s is None:
+        raise Http404("Unknown svg.")
+
+    response = HttpResponse(s, content_type='image/svg+xml')
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+# Number of the best submissions shown on the leaderboard.
+LEADERBOARD_SIZE = getattr(settings, 'NOTECHECK_LEADERBOARD_SIZE', 10)
+
+def leaderboard(request, token):
+    ex = Exercise.objects.select_related(*EXERCISE_RELATED).get(token=token)
+    if not ex.active:
+        return HttpResponse("Exercise not activated.")
 
-    return questions, answers
+    ex = ex.get_instance()
+    submissions = Submission.get_perfect(ex.token).order_by('duration')[:LEADERBOARD_SIZE]
+    context = {
+        "exercise": ex,
+        "submissions": [{
+            "rank": i+1,
+            "duration": "{m}:{s:02d}".format(m=int(s.duration.total_seconds()//60), s=int(s.duration.total_seconds()%60)),
+            "created": s.created,
+        } for i, s in enumerate(submissions)],
+    }
+    template = loader.get_template('notecheck/leaderboard.html')
+    return HttpResponse(template.render(context, request))
 
 def playnotepitch(request):
     template = loader.get_template('notecheck/playnotepitch.html')
     return HttpResponse(template.render({}, request))
 
-def submission(request, token, submission_id=None):
-    template = get_template(token)
-    ex = Exercise.objects.get(token=token)
+def get_submission(request, token, submission_id=None):
+    """returns the template, the exercise and the new, posted or viewed submission,
+    or the response if the exercise is not available"""
+    ex = Exercise.objects.select_related(*EXERCISE_RELATED).get(token=token)
     if not ex:
         return HttpResponse("Invalid exercise token.")
+    template = get_template(ex)
 
     if not ex.active:
         return HttpResponse("Exercise not activated.")
@@ -74,12 +177,13 @@ def submission(request, token, submission_id=None):
     ex = ex.get_instance()
     submission: Submission
 
+    submissions = Submission.objects.select_related('token', *['token__' + r for r in EXERCISE_RELATED])
     if request.method == 'POST':
         # Post filled submission.
-        submission = Submission.objects.get(id=request.POST['submission_id'])
+        submission = submissions.get(id=request.POST['submission_id'])
     elif request.method == 'GET' and submission_id:
         # View-only.
-        submission = Submission.objects.get(id=submission_id)
+        submission = submissions.get(id=submission_id)
     else:
         # Create new submission.
         submission = Submission(
@@ -103,18 +207,55 @@ def submission(request, token, submission_id=None):
 
         submission.answers = ans
         submission.duration = datetime.now(timezone.utc)-submission.created
+        submission.store_score()
         submission.save()
 
-    questions, answers = get_questions_answers(submission, settings.LANGUAGE_CODE)
+    return template, ex, submission
 
+def render_submission(request, template, ex, submission, questions, answers, svg_defs):
     context = {
         "exercise": ex,
         "submission": submission,
         "questions": questions,
         "answers": answers,
+        "svg_defs": svg_defs,
         "num_correct": submission.get_score(lang=settings.LANGUAGE_CODE),
         "top_10": submission.get_score(lang=settings.LANGUAGE_CODE)/len(answers) >= 0.9,
         "besttime": submission.get_score(lang=settings.LANGUAGE_CODE)==len(answers) and submission.get_besttime(lang=settings.LANGUAGE_CODE)>=submission.duration,
         "duration": "{m}:{s}".format(m=int(submission.duration.total_seconds()//60), s=int(submission.duration.total_seconds()%60))
     }
     return HttpResponse(template.render(context, request))
+
+def render_error():
+    # Renderer is overloaded or failing. The submission is already saved, so retrying is safe.
+    response = HttpResponse("Questions could not be rendered, please try again.", status=503)
+    response['Retry-After'] = '5'
+    return response
+
+def submission(request, token, submission_id=None):
+    result = get_submission(request, token, submission_id)
+    if isinstance(result, HttpResponse):
+        return result
+    template, ex, submission = result
+
+    try:
+        questions, answers, svg_defs = get_questions_answers(submission, settings.LANGUAGE_CODE)
+    except RenderError:
+        return render_error()
+
+    return render_submission(request, template, ex, submission, questions, answers, svg_defs)
+
+async def submission_async(request, token, submission_id=None):
+    """submission view which awaits the renders, so a single ASGI worker serves other
+    students meanwhile. Database access runs in the sync_to_async thread."""
+    result = await sync_to_async(get_submission)(request, token, submission_id)
+    if isinstance(result, HttpResponse):
+        return result
+    template, ex, submission = result
+
+    try:
+        questions, answers, svg_defs = await get_questions_answers_async(submission, settings.LANGUAGE_CODE)
+    except RenderError:
+        return render_error()
+
+    return await sync_to_async(render_submission)(request, template, ex, submission, questions, answers, svg_defs)
@@ -128,3 +128,23 @@ STATIC_URL = '/static/'
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Svg rendering backend of the questions: 'lilypond' (high-fidelity, requires
+# lilypond binary) or 'native' (fast, pure python)
+
+NOTECHECK_RENDERER = env.get('NOTECHECK_RENDERER', 'lilypond')
+
+# Inline svgs into the page instead of referencing them by their cacheable
+# /svg/<hash>.svg URL
+
+NOTECHECK_INLINE_SVG = 'NOTECHECK_INLINE_SVG' in env
+
+# Size budget of the rendered svg cache dir in bytes
+
+NOTECHECK_CACHE_MAX_BYTES = int(env.get('NOTECHECK_CACHE_MAX_BYTES', 512*1024*1024))
+
+# Serve the exercise pages by an async view which awaits the renders, when
+# deployed on an ASGI server
+
+NOTECHECK_ASYNC_VIEWS = 'NOTECHECK_ASYNC_VIEWS' in env